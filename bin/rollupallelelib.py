@@ -29,13 +29,19 @@
 import gc
 import os
 import db
-import copy
+import itertools
+import collections
+import bisect
 import mgi_utils
 
 ###--- globals ---###
 
 db.setTrace()
-Error = 'rollupallelelib.Error'
+
+class Error(Exception):
+        # exception raised by this module
+        pass
+
 DEBUG = False
 
 MAX_ANNOTATIONS = 5000		# maximum number of annotations to cache in
@@ -48,29 +54,27 @@ SOURCE_ANNOT_KEY = None		# term key for _SourceAnnot_key property
 
 INITIALIZED = False		# have we finished initializing this module?
 
-ANNOTATION_COUNTS = {}		# allele key -> count of rolled-up annotations
-
 ALLELE_KEYS = []		# ordered list of allele keys
 
+ANNOTATION_TOTALS = []		# running total of rolled-up annotations, parallel to ALLELE_KEYS
+
 LAST_ALLELE_KEY_INDEX = None	# index into ALLELE_KEYS of last allele key which had its details loaded
 
-ALLELES_TO_DO = []		# list of alleles loaded and waiting to be processed
+PREPARED = set()		# names of statements prepared in this session
+
+ALLELES_TO_DO = collections.deque()	# alleles loaded and waiting to be processed
 
 TERM_MAP = None			# KeyMap for term key -> term ID
 ALLELE_MAP = None		# KeyMap for allele key -> allele ID
-JNUM_MAP = None			# KeyMap for refs key -> J: number
-EVIDENCE_MAP = None		# KeyMap for evidence key -> evidence abbrev.
 QUALIFIER_MAP = None		# KeyMap for qualifier key -> qualifier term
-USER_MAP = None			# KeyMap for user key -> user
 PROPERTY_MAP = None		# KeyMap for property key -> property name
 
+NOTE_WHITESPACE = str.maketrans('\n\t', '  ')	# newlines and tabs -> spaces, for notes
+
 # no testing
-testSQL = ""
+testGenotypes = []
 
-#testSQL = '''
-#and exists (select 1 from ACC_Accession testg 
-#where gag._genotype_key = testg._object_key and testg._mgitype_key = 12 
-#and testg.accid in (
+#testGenotypes = [
 #'MGI:3776488',
 #'MGI:2667804',
 #'MGI:2173405',
@@ -92,9 +96,10 @@ testSQL = ""
 #'MGI:3814907',
 #'MGI:5690044',
 #'MGI:6450805'
-#)
-#)
-#'''
+#]
+
+# extra where clause restricting genotypes to testGenotypes; set by _buildTestGenotypes()
+testSQL = ""
 
 ###--- classes ---###
 
@@ -104,15 +109,14 @@ class KeyMap:
         # Does: populates the mapping from the database and provides easy
         #	access to look up the value for each key
 
+        __slots__ = ('mapping',)
+
         def __init__ (self, query, keyField, valueField):
                 # instantiate a new key mapping using the given SQL 'query',
                 # using values for 'keyField' as the keys and values for
                 # 'valueField' for their corresponding values
 
-                self.mapping = {}
-
-                for row in db.sql(query, 'auto'):
-                        self.mapping[row[keyField]] = row[valueField]
+                self.mapping = { row[keyField] : row[valueField] for row in db.sql(query, 'auto') }
                 return
 
         def __len__ (self):
@@ -123,9 +127,7 @@ class KeyMap:
                 # return the value corresponding to the given key, or None
                 # if there is no value for that 'key'
 
-                if key in self.mapping:
-                        return self.mapping[key]
-                return None
+                return self.mapping.get(key)
 
 class Allele:
         # Is: a single allele from the database
@@ -138,6 +140,9 @@ class Allele:
         #	object, you can no longer call any set*() methods.  This is
         #	due to the need to prepare the data (as noted above).
 
+        __slots__ = ('finalized', 'alleleKey', 'annotations', 'evidence',
+                'evidenceProperties', 'notes', 'finalAnnotations')
+
         def __init__ (self, alleleKey):
                 # constructor; initializes object for allele with given key
 
@@ -156,7 +161,7 @@ class Allele:
                 # evidence key -> list of property rows
                 self.evidenceProperties = {}
 
-                # evidence key -> { note key : { note record } }
+                # evidence key -> { note key : note text }
                 self.notes = {}
 
                 # output data to be computed by finalize() method, in columns
@@ -168,63 +173,46 @@ class Allele:
                 # concatenate the various notes together from noteDict
                 # for the given 'evidenceKey'
 
-                notes = ''
-                if evidenceKey in self.notes:
-                        for (noteKey, noteRow) in list(self.notes[evidenceKey].items()):
-                                if notes:
-                                        notes = notes.strip() + ' '
-                                notes = notes + noteRow['note']
+                noteRows = self.notes.get(evidenceKey)
+                if not noteRows:
+                        return ''
+
+                # trailing whitespace is trimmed from each note, and blank
+                # notes are skipped, so the notes are separated by one space
+
+                notes = [ note.rstrip() for note in noteRows.values() ]
 
-                return notes.replace('\n', ' ').replace('\t', ' ').strip()
+                return ' '.join([ note for note in notes if note ]).translate(NOTE_WHITESPACE).strip()
 
         def _buildPropertiesValue (self, evidenceKey):
                 # build a str.to encapsulate the various properties in the
                 # manner expected by the annotload
 
-                stanzas = []
+                rows = self.evidenceProperties.get(evidenceKey)
+                if not rows:
+                        return ''
 
-                if evidenceKey in self.evidenceProperties:
-                        lastStanza = None
+                propertyMap = PROPERTY_MAP.mapping
 
-                        for row in self.evidenceProperties[evidenceKey]:
-                                stanza = row['stanza']
+                # rows arrive ordered by stanza, so each run of rows with the
+                # same stanza is one stanza.  Use &==& to separate clauses
+                # within a stanza, and use &===& to separate the stanzas.
 
-                                # if we have a change in stanza, then add a
-                                # new stanza to our list of stanzas
+                return '&===&'.join([
+                        '&==&'.join([
+                                '%s&=&%s' % (propertyMap.get(row['_PropertyTerm_key']), row['value'])
+                                for row in stanzaRows ])
+                        for (stanza, stanzaRows) in itertools.groupby(rows, lambda row: row['stanza']) ])
 
-                                if lastStanza != stanza:
-                                        lastStanza = stanza
-                                        stanzas.append([])
-
-                                # compose our clause and add it to the most
-                                # recent stanza
-
-                                clause = '%s&=&%s' % ( PROPERTY_MAP.get(row['_PropertyTerm_key']), row['value'] )
-                                stanzas[-1].append(clause)
-
-                # finally, use &==& to separate clauses within a stanza, and
-                # use &===& to separate the stanzas
-
-                x = []
-                for stanza in stanzas:
-                        x.append('&==&'.join(stanza))
-
-                return '&===&'.join(x)
-
-        def finalize (self):
-                # The finalize() method takes this allele object from its
-                # original state (old primary keys, old annotation types) and
-                # converts them to rows appropriate to be loaded as new
-                # records by the annotation loader.  This can be called
-                # multiple times, as it will be a no-op if the allele is
-                # already finalized.
-
-                if self.finalized:
-                        return
+        def _buildRows (self):
+                # generator; converts this allele object from its original
+                # state (old primary keys, old annotation types) to rows
+                # appropriate to be loaded as new records by the annotation
+                # loader, yielding one row at a time
 
                 # The input file for the annotation loader allows up to eleven
-                # fields per line.  We will generate rows in that format for
-                # self.finalAnnotations, specifically for our data set:
+                # fields per line.  We will generate rows in that format,
+                # specifically for our data set:
                 #    1. vocab term ID
                 #    2. allele ID
                 #    3. J: num
@@ -237,33 +225,38 @@ class Allele:
                 #   10. empty -- defaults to MGI IDs for alleles
                 #   11. properties -- can be empty
 
-                self.finalAnnotations = []
+                # bind the key map dictionaries to locals once, as they are
+                # consulted for every annotation and evidence row below
+
+                termMap = TERM_MAP.mapping
+                alleleMap = ALLELE_MAP.mapping
+                qualifierMap = QUALIFIER_MAP.mapping
+                debug = DEBUG
 
                 for annotRow in self.annotations:
                         annotKey = annotRow['_Annot_key']
 
-                        termID = TERM_MAP.get(annotRow['_Term_key'])
-                        alleleID = ALLELE_MAP.get(annotRow['_Allele_key'])
-                        qualifier = QUALIFIER_MAP.get( annotRow['_Qualifier_key'])
-
-                        if qualifier == None:
-                                qualifier = ''
+                        termID = termMap.get(annotRow['_Term_key'])
+                        alleleID = alleleMap.get(annotRow['_Allele_key'])
+                        qualifier = qualifierMap.get(annotRow['_Qualifier_key']) or ''
 
                         if annotKey not in self.evidence:
                                 continue
 
-                        for evidRow in self.evidence[annotKey]:
-                                evidKey = evidRow['_AnnotEvidence_key']
-                                inferredFrom = evidRow['inferredFrom']
-                                evidenceCode = EVIDENCE_MAP.get( evidRow['_EvidenceTerm_key'])
-                                jnumID = JNUM_MAP.get( evidRow['_Refs_key'])
-                                user = USER_MAP.get(evidRow['_ModifiedBy_key'])
+                        # in debug mode only the term and allele IDs are
+                        # written, so skip building the rest of the row
 
-                                if inferredFrom == None:
-                                        inferredFrom = ''
+                        if debug:
+                                for evidRow in self.evidence[annotKey]:
+                                        yield ( termID, alleleID )
+                                continue
 
-                                if qualifier == None:
-                                        qualifier = ''
+                        for evidRow in self.evidence[annotKey]:
+                                evidKey = evidRow['_AnnotEvidence_key']
+                                inferredFrom = evidRow['inferredFrom'] or ''
+                                evidenceCode = evidRow['abbreviation']
+                                jnumID = evidRow['jnumID']
+                                user = evidRow['login']
 
                                 # concatenate all notes together into a single
                                 # mega-note, as the annotation loader can only
@@ -277,30 +270,47 @@ class Allele:
 
                                 properties = self._buildPropertiesValue(evidKey)
 
-                                if DEBUG:
-                                        row = [
-                                                termID,
-                                                alleleID
-                                                ]
-                                else:
-                                        row = [
-                                                termID,
-                                                alleleID,
-                                                jnumID,
-                                                evidenceCode,
-                                                inferredFrom,
-                                                qualifier,
-                                                user,
-                                                '',
-                                                notes,
-                                                '',
-                                                properties
-                                                ]
-
-                                self.finalAnnotations.append(row) 
+                                row = (
+                                        termID,
+                                        alleleID,
+                                        jnumID,
+                                        evidenceCode,
+                                        inferredFrom,
+                                        qualifier,
+                                        user,
+                                        '',
+                                        notes,
+                                        '',
+                                        properties
+                                        )
+
+                                yield row
+
+                return
+
+        def _release (self):
+                # drop the input data, which is no longer needed once this
+                # allele is finalized
+                self.annotations = None
+                self.evidence = None
+                self.evidenceProperties = None
+                self.notes = None
+                return
+
+        def finalize (self):
+                # The finalize() method collects the rows from _buildRows()
+                # into self.finalAnnotations.  This can be called multiple
+                # times, as it will be a no-op if the allele is already
+                # finalized.
+
+                if self.finalized:
+                        return
+
+                self.finalAnnotations = list(self._buildRows())
 
                 # finished translating old records to new records
                 self.finalized = True
+                self._release()
                 return
 
         def checkWriteable (self, setWhat):
@@ -335,6 +345,24 @@ class Allele:
                 self.finalize()
                 return self.finalAnnotations
 
+        def writeAnnotations (self, fp, template):
+                # writes this allele's annotation rows to file 'fp', formatting
+                # each with the given line 'template', without collecting them
+                # in self.finalAnnotations.  Finalizes the allele.  Lines are
+                # handed to the file in one writelines() call.
+
+                if self.finalized:
+                        rows = self.finalAnnotations
+                else:
+                        rows = self._buildRows()
+
+                fp.writelines(map(template.__mod__, rows))
+
+                self.finalAnnotations = []
+                self.finalized = True
+                self._release()
+                return
+
 ###--- private functions ---###
 
 def _stamp (s):
@@ -343,22 +371,22 @@ def _stamp (s):
         print(s)
         return
 
+# _stampResults(), _addKeeper() and _deleteKeeper() are debugging aids
+# only; callers check DEBUG before calling them.
+
 def _stampResults(s, order = ''):
-        if DEBUG:
-                results = db.sql('select * from %s %s' % (s, order), 'auto')
-                for r in results:
-                        _stamp(r)
-                _stamp('\n')
+        results = db.sql('select * from %s %s' % (s, order), 'auto')
+        for r in results:
+                _stamp(r)
+        _stamp('\n')
 
 def _addKeeper():
-        if DEBUG:
-                _stamp('after add to genotype_keepers')
-                _stampResults('genotype_keepers', 'order by gaccid, aaccid')
+        _stamp('after add to genotype_keepers')
+        _stampResults('genotype_keepers', 'order by gaccid, aaccid')
 
 def _deleteKeeper():
-        if DEBUG:
-                _stamp('after delete from genotype_keepers')
-                _stampResults('genotype_keepers', 'order by gaccid, aaccid')
+        _stamp('after delete from genotype_keepers')
+        _stampResults('genotype_keepers', 'order by gaccid, aaccid')
 
 def _deleteScratchpad():
         if DEBUG:
@@ -369,42 +397,131 @@ def _deleteScratchpad():
         _countAllelePerGenotype('scratchpad')
 
 def _getCount(table):
+        # return the number of rows in 'table'; each call is a full count of
+        # the table, so the row-count log messages are only written in DEBUG
         results = db.sql('select count(1) as get_count from %s' % table, 'auto')
         if not results:
                 return 0
         return results[0]['get_count']
 
+def _buildTestGenotypes():
+        # when testing, collect the genotype keys for the MGI IDs listed in
+        # testGenotypes into a temp table (test_genotypes) and point testSQL
+        # at it, so the genotype queries join to a small indexed table rather
+        # than re-checking ACC_Accession against a literal list each time
+
+        global testSQL
+
+        if not testGenotypes:
+                return
+
+        _stamp('0:_buildTestGenotypes/test_genotypes')
+
+        cmd = '''
+                select distinct a._Object_key as _Genotype_key
+                into temp table test_genotypes
+                from ACC_Accession a
+                where a._MGIType_key = 12
+                and a.accid in (%s)
+                ''' % ','.join(["'%s'" % x for x in testGenotypes])
+
+        db.sql(cmd, None)
+        db.sql('create unique index tmp_test_genotypes on test_genotypes (_Genotype_key)', None)
+        if DEBUG:
+                _stamp('0:test_genotypes : %d\n' % _getCount('test_genotypes'))
+
+        testSQL = 'and gag._Genotype_key in (select _Genotype_key from test_genotypes)'
+
+        return
+
 def _countAllelePerGenotype(table):
         # collect into a temp table (genotype_allele_counts) the genotypes that
-        # have annotations attached, along with the count of allele pairs for each genotype
+        # have annotations attached, along with the count of allele pairs for each genotype.
+        # The table and its index are created once from GXD_AlleleGenotype; each
+        # re-count from scratchpad truncates and refills it in place.
 
         _stamp('1:_countAllelePerGenotype')
 
-        db.sql('drop table if exists genotype_allele_counts', None);
-
         if (table == 'GXD_AlleleGenotype'):
+                db.sql('drop table if exists genotype_allele_counts', None);
                 cmd = '''
                         select gag._Genotype_key, count(1) as allele_count
                         into temp table genotype_allele_counts
                         from GXD_AlleleGenotype gag
-                        where exists (select 1 from VOC_Annot v
-                                where v._AnnotType_key in (%d)
-                                and v._Object_key = gag._Genotype_key
+                        where exists (select 1 from annotated_genotypes ag
+                                where ag._Genotype_key = gag._Genotype_key
                                 )
                         %s
                         group by gag._Genotype_key
-                        ''' % (CURRENT_ANNOT_TYPE, testSQL)
+                        ''' % testSQL
+                db.sql(cmd, None)
+                db.sql('create index tmp_by_count on genotype_allele_counts (allele_count, _Genotype_key)', None)
         else:
                 cmd = '''
+                        insert into genotype_allele_counts
                         select gag._Genotype_key, count(1) as allele_count
-                        into temp table genotype_allele_counts
                         from scratchpad gag
                         group by gag._Genotype_key
                         '''
+                db.sql('truncate table genotype_allele_counts', None)
+                db.sql(cmd, None)
+
+        if DEBUG:
+                _stamp('1:genotype_allele_counts : %d\n' % _getCount('genotype_allele_counts'))
+
+        return
+
+def _buildAccessionCache():
+        # collect into a temp table (accid_cache) the MGI IDs of all genotypes
+        # and the preferred MGI IDs of all alleles, so the genotype_keepers
+        # and scratchpad queries can probe a small indexed table rather than
+        # joining ACC_Accession twice apiece
+
+        _stamp('0:_buildAccessionCache/accid_cache')
+
+        cmd = '''
+                select a._Object_key, a._MGIType_key, a.accid
+                into temp table accid_cache
+                from ACC_Accession a
+                where a._logicaldb_key = 1
+                        and a.prefixpart = 'MGI:'
+                        and (a._MGIType_key = 12
+                                or (a._MGIType_key = 11 and a.preferred = 1)
+                        )
+                '''
+
+        db.sql(cmd, None)
+        db.sql('create index accid_cache_idx on accid_cache (_MGIType_key, _Object_key)', None)
+        if DEBUG:
+                _stamp('0:built accid_cache table rows: %d\n' % _getCount('accid_cache'))
+
+        return
+
+def _buildAnnotatedGenotypes():
+        # collect into a temp table (annotated_genotypes) the genotypes that
+        # have annotations of the current type, along with each genotype's
+        # isConditional flag and MGI ID; the allele counts, genotype_keepers
+        # and scratchpad queries probe this table rather than each joining
+        # GXD_Genotype, VOC_Annot and accid_cache on their own
+
+        _stamp('0:_buildAnnotatedGenotypes/annotated_genotypes')
+
+        cmd = '''
+                select distinct g._Genotype_key, g.isConditional, a1.accid as gaccid
+                into temp table annotated_genotypes
+                from GXD_Genotype g, accid_cache a1
+                where g._Genotype_key = a1._Object_key
+                        and a1._MGIType_key = 12
+                        and exists (select 1 from VOC_Annot v
+                                where v._AnnotType_key = %d
+                                and v._Object_key = g._Genotype_key
+                                )
+                ''' % CURRENT_ANNOT_TYPE
 
         db.sql(cmd, None)
-        db.sql('create index tmp_by_count on genotype_allele_counts (allele_count, _Genotype_key)', None)
-        _stamp('1:genotype_allele_counts : %d\n' % _getCount('genotype_allele_counts'))
+        db.sql('create index annotated_genotypes_idx on annotated_genotypes (_Genotype_key)', None)
+        if DEBUG:
+                _stamp('0:built annotated_genotypes table rows: %d\n' % _getCount('annotated_genotypes'))
 
         return
 
@@ -451,13 +568,12 @@ def _keepNaturallySimpleGenotypes():
                 insert into genotype_keepers
                 select distinct g._Genotype_key,
                         'rule #1 : one allele genotype',
-                        p._Allele_key, a.symbol, a1.accid, a2.accid
+                        p._Allele_key, a.symbol, gg.gaccid, a2.accid
                 from genotype_allele_counts g,
                         GXD_AlleleGenotype p,
-                        GXD_Genotype gg,
+                        annotated_genotypes gg,
                         ALL_Allele a,
-                        ACC_Accession a1,
-                        ACC_Accession a2
+                        accid_cache a2
                 where g.allele_count = 1
                         and g._Genotype_key = p._Genotype_key
                         and p._Genotype_key = gg._Genotype_key
@@ -465,15 +581,8 @@ def _keepNaturallySimpleGenotypes():
                         and gg.isConditional = 0        
                         and p._Allele_key = a._Allele_key
 
-                        and g._Genotype_key = a1._Object_key
-                        and a1._MGIType_key = 12
-                        and a1._logicaldb_key = 1
-                        and a1.prefixpart = 'MGI:'
                         and p._Allele_key = a2._Object_key
                         and a2._MGIType_key = 11
-                        and a2._logicaldb_key = 1
-                        and a2.prefixpart = 'MGI:'
-                        and a2.preferred = 1
 
                         -- 4.3:wildtype = false')
                         and exists (select 1
@@ -485,8 +594,9 @@ def _keepNaturallySimpleGenotypes():
                 '''
 
         db.sql(cmd, None)
-        _stamp('3:add naturally simple genotypes: %d\n' % _getCount('genotype_keepers'))
-        _addKeeper()
+        if DEBUG:
+                _stamp('3:add naturally simple genotypes: %d\n' % _getCount('genotype_keepers'))
+                _addKeeper()
 
         return
 
@@ -495,6 +605,44 @@ def _indexKeepersTable():
         _stamp('4:_indexKeepersTable\n\n')
         db.sql('create index gk_genotype on genotype_keepers (_Genotype_key)', None)
         db.sql('create index gk_allele on genotype_keepers (_Allele_key, _Genotype_key)', None)
+        if DEBUG:
+                db.sql('create index gk_accids on genotype_keepers (gaccid, aaccid)', None)
+        return
+
+def _buildAlleleSubtypeFlags():
+        # collect into a temp table (allele_subtypes) one row per allele that
+        # has allele subtype (attribute) annotations, with a flag for each
+        # subtype that the rollup rules test.  This replaces separate scans
+        # of VOC_Annot in each of the rules below.
+        #   is_transgenic : allele type/generation type "Transgenic"
+        #   is_reporter : subtype "Reporter"
+        #   has_nonreporter : any subtype other than "Reporter"
+        #   is_transactivator : subtype "Transactivator"
+        #   is_recombinase : subtype "Recombinase"
+        #   is_ies : subtype "Inserted expressed sequence"
+
+        _stamp('5a:_buildAlleleSubtypeFlags/allele_subtypes')
+
+        cmd = '''
+                select a._Allele_key,
+                        a._Allele_Type_key = 847126 as is_transgenic,
+                        bool_or(v._Term_key = 11025589) as is_reporter,
+                        bool_or(v._Term_key != 11025589) as has_nonreporter,
+                        bool_or(v._Term_key = 13289567) as is_transactivator,
+                        bool_or(v._Term_key = 11025588) as is_recombinase,
+                        bool_or(v._Term_key = 11025597) as is_ies
+                into temp table allele_subtypes
+                from ALL_Allele a, VOC_Annot v
+                where a._Allele_key = v._Object_key
+                        and v._AnnotType_key = 1014     -- allele subtype annotation
+                group by a._Allele_key, a._Allele_Type_key
+                '''
+
+        db.sql(cmd, None)
+        db.sql('create unique index tmp_allele_subtypes on allele_subtypes (_Allele_key)', None)
+        if DEBUG:
+                _stamp('5a:built allele_subtypes table rows: %d\n' % _getCount('allele_subtypes'))
+
         return
 
 def _identifyReporterTransgenes():
@@ -510,25 +658,18 @@ def _identifyReporterTransgenes():
         _stamp('6.3. allele subtype/attribute no other subtype selected')
 
         cmd = '''
-                select distinct a._Allele_key
+                select s._Allele_key
                 into temp table reporter_transgenes
-                from ALL_Allele a
-                where a._Allele_Type_key = 847126              
-                        and exists (select 1 from VOC_Annot v   -- transgenic
-                                where a._Allele_key = v._Object_key -- allele subtype annotation
-                                and v._AnnotType_key = 1014         -- reporter
-                                and v._Term_key = 11025589      
-                                )
-                        and not exists (select 1 from VOC_Annot v
-                                where a._Allele_key = v._Object_key -- allele subtype annotation
-                                and v._AnnotType_key = 1014         -- not reporter
-                                and v._Term_key != 11025589     
-                                )
+                from allele_subtypes s
+                where s.is_transgenic
+                        and s.is_reporter
+                        and not s.has_nonreporter
                 '''
 
         db.sql(cmd, None)
         db.sql('create unique index tmp_reportertg on reporter_transgenes (_Allele_key)', None)
-        _stamp('6:built reporter_transgenes table rows: %d\n' % _getCount('reporter_transgenes'))
+        if DEBUG:
+                _stamp('6:built reporter_transgenes table rows: %d\n' % _getCount('reporter_transgenes'))
 
         return
 
@@ -538,8 +679,7 @@ def _identifyTransactivators():
         #   2. have an attribute (subtype) of "Transactivator"
         #   3. do NOT have an "inserted expressed sequence" attribute
 
-        # The "distinct" should be superfluous, but we'll include it just in
-        # case something flaky comes up.
+        # allele_subtypes has one row per allele, so no "distinct" is needed.
 
         _stamp('9:_identifyTransactivators/transactivators')
         _stamp('9.1: allele type/generation type "Transgenic" = true')
@@ -547,25 +687,18 @@ def _identifyTransactivators():
         _stamp('9.3: allele subtype/attribute "Inserted_expressed_sequence" = false')
 
         cmd = '''
-                select distinct a._Allele_key
+                select s._Allele_key
                 into temp table transactivators
-                from all_allele a, voc_annot t
-                where a._Allele_Type_key = 847126         -- transgenic
-                        and exists (select 1 from VOC_Annot v
-                                where a._Allele_key = v._Object_key
-                                and v._AnnotType_key = 1014    -- allele subtype annotation
-                                and v._Term_key = 13289567     -- transactivator
-                        )
-                        and not exists (select 1 from VOC_Annot v
-                                where a._Allele_key = v._Object_key
-                                and v._AnnotType_key = 1014     -- allele subtype annotation
-                                and v._Term_key = 11025597      -- inserted_expressed_sequence
-                                )
+                from allele_subtypes s
+                where s.is_transgenic
+                        and s.is_transactivator
+                        and not s.is_ies
                 '''
 
         db.sql(cmd, None)
         db.sql('create unique index tmp_transactivators on transactivators (_Allele_key)', None)
-        _stamp('9:built transactivators table rows: %d\n' % _getCount('transactivators'))
+        if DEBUG:
+                _stamp('9:built transactivators table rows: %d\n' % _getCount('transactivators'))
 
         return
 
@@ -585,34 +718,27 @@ def _buildScratchPad():
                         gag._Allele_key,
                         g.isConditional,
                         a.symbol,
-                        a1.accid as gaccid,
+                        g.gaccid,
                         a2.accid as aaccid
                 into temp table scratchpad
                 from genotype_allele_counts c,
                         GXD_AlleleGenotype gag,
-                        GXD_Genotype g,
+                        annotated_genotypes g,
                         ALL_Allele a,
-                        ACC_Accession a1,
-                        ACC_Accession a2
+                        accid_cache a2
                 where not exists (select 1 from genotype_keepers k 
                         where c._Genotype_key = k._Genotype_key)
                         and c._Genotype_key = gag._Genotype_key
                         and c._Genotype_key = g._Genotype_key
                         and gag._Allele_key = a._Allele_key
-                        and gag._Genotype_key = a1._Object_key
-                        and a1._MGIType_key = 12
-                        and a1._logicaldb_key = 1
-                        and a1.prefixpart = 'MGI:'
                         and gag._Allele_key = a2._Object_key
                         and a2._MGIType_key = 11
-                        and a2._logicaldb_key = 1
-                        and a2.prefixpart = 'MGI:'
-                        and a2.preferred = 1
                 '''
 
         db.sql(cmd, None)
         db.sql('create index scratch_alleles on scratchpad (_Allele_key)', None)
-        _stamp('5:built scratchpad table rows: %d\n' % _getCount('scratchpad'))
+        if DEBUG:
+                _stamp('5:built scratchpad table rows: %d\n' % _getCount('scratchpad'))
         _deleteScratchpad()
 
         return
@@ -625,7 +751,8 @@ def _removeConditionalGenotypes():
         _stamp('7.2:allele attribute Recombinase = true')
         _stamp('7.3:allele attribute "inserted expressed sequence" = false')
 
-        before = _getCount('scratchpad')
+        if DEBUG:
+                before = _getCount('scratchpad')
 
         cmd = '''
                 delete from scratchpad p
@@ -633,23 +760,18 @@ def _removeConditionalGenotypes():
                 where p.isConditional = 1
 
                         -- 8.2:allele attribute Recombinase = true
-                        and exists (select 1 from VOC_Annot v
-                                where p._Allele_key = v._Object_key
-                                and v._AnnotType_key = 1014       -- allele subtype annotation
-                                and v._Term_key = 11025588        -- recombinase
-                                )
-
                         -- 8.3:allele attribute "inserted expressed sequence" = false
-                        and not exists (select 1 from VOC_Annot v
-                                where p._Allele_key = v._Object_key
-                                and v._AnnotType_key = 1014    -- allele subtype annotation
-                                and v._Term_key = 11025597     -- inserted expressed sequence
+                        and exists (select 1 from allele_subtypes s
+                                where p._Allele_key = s._Allele_key
+                                and s.is_recombinase
+                                and not s.is_ies
                                 )
 
                '''
 
         db.sql(cmd, None)
-        _stamp('7:delete recombinase alleles from scratchpad: %d\n' % (before - _getCount('scratchpad'))) 
+        if DEBUG:
+                _stamp('7:delete recombinase alleles from scratchpad: %d\n' % (before - _getCount('scratchpad')))
         _deleteScratchpad()
 
         return
@@ -658,8 +780,13 @@ def _cleanupTempTables():
         # drop any temp tables that we're done with
 
         tables = [ 
+                'test_genotypes',
+                'accid_cache',
+                'annotated_genotypes',
+                'allele_subtypes',
                 'genotype_allele_counts',
                 'genotype_keepers',
+                'batch_annots',
                 'reporter_transgenes',
                 'transactivators',
                 'scratchpad',
@@ -680,10 +807,12 @@ def _removeReporterTransgenes():
 
         _stamp('8:_removeReporterTransgenes/scratchpad')
         _stamp('8:reporter_transgenes = true')
-        before = _getCount('scratchpad')
+        if DEBUG:
+                before = _getCount('scratchpad')
         #_stampResults('reporter_transgenes')
         db.sql('delete from scratchpad p where exists (select 1 from reporter_transgenes r where p._allele_key = r._allele_key)', None)
-        _stamp('8:delete reporter transgenes from scratchpad: %d\n' % (before - _getCount('scratchpad')))
+        if DEBUG:
+                _stamp('8:delete reporter transgenes from scratchpad: %d\n' % (before - _getCount('scratchpad')))
         _deleteScratchpad()
 
         return 
@@ -694,9 +823,11 @@ def _removeTransactivators():
         _stamp('10:_removeTransactivators/scratchpad')
         _stamp('10:transactivators = true')
         #_stampResults('transactivators')
-        before = _getCount('scratchpad')
+        if DEBUG:
+                before = _getCount('scratchpad')
         db.sql('delete from scratchpad p where exists (select 1 from transactivators t where p._allele_key = t._allele_key)', None)
-        _stamp('10:delete transactivators from scratchpad: %d\n' % ( before - _getCount('scratchpad')) )
+        if DEBUG:
+                _stamp('10:delete transactivators from scratchpad: %d\n' % ( before - _getCount('scratchpad')) )
         _deleteScratchpad()
 
         return 
@@ -716,7 +847,8 @@ def _identifyWildTypeAlleles():
 
         db.sql(cmd, None)
         db.sql('create unique index wt_alleles on wildtype_alleles (_Allele_key)', None)
-        _stamp('11:wildtype_alleles table rows: %d\n' % _getCount('wildtype_alleles'))
+        if DEBUG:
+                _stamp('11:wildtype_alleles table rows: %d\n' % _getCount('wildtype_alleles'))
 
         return
 
@@ -725,10 +857,12 @@ def _removeWildTypeAllelesFromScratchPad():
 
         _stamp('12:_removeWildTypeAllelesFromScratchPad/scratchpad')
         _stamp('12:wildtype_alleles = true')
-        before = _getCount('scratchpad')
-        _stampResults('wildtype_alleles')
+        if DEBUG:
+                before = _getCount('scratchpad')
+                _stampResults('wildtype_alleles')
         db.sql('delete from scratchpad p where exists (select 1 from wildtype_alleles w where p._allele_key = w._allele_key)', None)
-        _stamp('12:delete wild-type from scratchpad: %d\n' % ( before - _getCount('scratchpad')) )
+        if DEBUG:
+                _stamp('12:delete wild-type from scratchpad: %d\n' % ( before - _getCount('scratchpad')) )
         _deleteScratchpad()
 
         return
@@ -738,65 +872,74 @@ def _handleFinalAlleleSet():
 
         _stamp('13:_handleFinalAlleleSet')
 
-        before = _getCount('scratchpad')
+        if DEBUG:
+                before = _getCount('scratchpad')
         db.sql('delete from scratchpad where _Genotype_key in (select _Genotype_key from genotype_allele_counts where allele_count > 1)', None)
-        _stamp('13:delete multi-allele genotypes from scratchpad: %d\n' % ( before - _getCount('scratchpad')))
+        if DEBUG:
+                _stamp('13:delete multi-allele genotypes from scratchpad: %d\n' % ( before - _getCount('scratchpad')))
         _deleteScratchpad()
 
-        before = _getCount('genotype_keepers')
+        if DEBUG:
+                before = _getCount('genotype_keepers')
         cmd = '''
                 insert into genotype_keepers
                 select distinct s._Genotype_key, \'remaining scratchpad/single allele\', s._Allele_key, s.symbol, a1.accid, a2.accid
                 from scratchpad s,
-                        ACC_Accession a1,
-                        ACC_Accession a2
+                        accid_cache a1,
+                        accid_cache a2
                 where s._Genotype_key = a1._Object_key
                         and a1._MGIType_key = 12
-                        and a1._logicaldb_key = 1
-                        and a1.prefixpart = 'MGI:'
                         and s._Allele_key = a2._Object_key
                         and a2._MGIType_key = 11
-                        and a2.prefixpart = 'MGI:'
-                        and a2._logicaldb_key = 1
-                        and a2.preferred = 1
                  '''
         db.sql(cmd, None)
-        _stamp('13:add rows to genotype_keepers: %d' % (_getCount('genotype_keepers') - before))
-        _addKeeper()
+        if DEBUG:
+                _stamp('13:add rows to genotype_keepers: %d' % (_getCount('genotype_keepers') - before))
+                _addKeeper()
 
         return
 
 def _getAlleleMetaData():
-        # populate global variables with counts of annotations for each allele
-        # and an ordered list of allele keys to process.
+        # populate global variables with an ordered list of allele keys to
+        # process and the running total of their annotation counts.
 
-        global ANNOTATION_COUNTS, ALLELE_KEYS, LAST_ALLELE_KEY_INDEX
+        global ALLELE_KEYS, ANNOTATION_TOTALS, LAST_ALLELE_KEY_INDEX
 
         _stamp('14:_getAlleleMetaData')
 
-        ANNOTATION_COUNTS = {}
-        ALLELE_KEYS = []
         LAST_ALLELE_KEY_INDEX = None
 
+        # genotype_keepers is complete at this point; temp tables are never
+        # analyzed automatically, so gather statistics once for the planner
+        # before the count query and the per-batch range scans over
+        # gk_allele (_Allele_key, _Genotype_key)
+
+        db.sql('analyze genotype_keepers', None)
+
+        # the counts, and their running total in allele key order, are
+        # computed by the database in a single query
+
         cmd = '''
-                select k._Allele_key, count(1) as annotation_count
-                from genotype_keepers k, VOC_Annot a
-                where k._Genotype_key = a._Object_key
-                and a._AnnotType_key in (%s)
-                group by k._Allele_key
+                select c._Allele_key, c.annotation_count,
+                        (sum(c.annotation_count) over (order by c._Allele_key))::bigint as annotation_total
+                from (select k._Allele_key, count(1) as annotation_count
+                        from genotype_keepers k, VOC_Annot a
+                        where k._Genotype_key = a._Object_key
+                        and a._AnnotType_key = %d
+                        group by k._Allele_key
+                        ) c
+                order by c._Allele_key
                 ''' % (CURRENT_ANNOT_TYPE)
 
         results = db.sql(cmd, 'auto')
-        for row in results:
-                ANNOTATION_COUNTS[row['_Allele_key']] = row['annotation_count']
 
         if DEBUG:
                 for r in results:
                         _stamp(r)
                 _stamp('\n')
 
-        ALLELE_KEYS = list(ANNOTATION_COUNTS.keys())
-        ALLELE_KEYS.sort()
+        ALLELE_KEYS = [ row['_Allele_key'] for row in results ]
+        ANNOTATION_TOTALS = [ row['annotation_total'] for row in results ]
 
         _stamp('14:Retrieved annotation counts for %d alleles\n' % len(ALLELE_KEYS)) 
 
@@ -806,68 +949,65 @@ def _initializeKeyMaps():
         # initialize the mappings from various database keys to their
         # respective values
 
-        global TERM_MAP, ALLELE_MAP, JNUM_MAP, EVIDENCE_MAP
-        global QUALIFIER_MAP, USER_MAP, PROPERTY_MAP, CURRENT_ANNOT_TYPE
+        global TERM_MAP, ALLELE_MAP
+        global QUALIFIER_MAP, PROPERTY_MAP, CURRENT_ANNOT_TYPE
 
         _stamp('15:_initializeKeyMaps')
 
         if not CURRENT_ANNOT_TYPE:
                 raise Error('Need to call setAnnotationType()')
 
-        # map from annotated term IDs to their IDs
+        # map from annotated term IDs to their IDs; VOC_Term (and ALL_Allele
+        # below) are only joined when DEBUG needs the term (or symbol)
         if DEBUG:
                 accID = "ac.accID || ':' || t.term as accID"
+                debugFrom = ', VOC_Term t'
+                debugWhere = 'and ac._Object_key = t._Term_key'
         else:
                 accID = "ac.accID as accID"
+                debugFrom = ''
+                debugWhere = ''
 
         termCmd = '''
                 select distinct ac._Object_key, %s
-                from VOC_Annot va, ACC_Accession ac, VOC_Term t
-                where va._AnnotType_key in (%d)
-                and va._Term_key = ac._Object_key
-                and ac._MGIType_key = 13
+                from ACC_Accession ac %s
+                where ac._MGIType_key = 13
                 and ac.private = 0
                 and ac.preferred = 1
-                and va._Term_key = t._Term_key
-                ''' % (accID, CURRENT_ANNOT_TYPE)
+                and exists (select 1 from VOC_Annot va
+                        where va._AnnotType_key = %d
+                        and va._Term_key = ac._Object_key
+                        )
+                %s
+                ''' % (accID, debugFrom, CURRENT_ANNOT_TYPE, debugWhere)
         TERM_MAP = KeyMap(termCmd, '_Object_key', 'accID')
 
         # map from annotated alleles to their MGI IDs
         if DEBUG:
                 accID = "ac.accID || ':' || a.symbol as accID"
+                debugFrom = ', ALL_Allele a'
+                debugWhere = 'and ac._Object_key = a._Allele_key'
         else:
                 accID = "ac.accID as accID"
+                debugFrom = ''
+                debugWhere = ''
 
         alleleCmd = '''
                 select distinct ac._Object_key, %s
-                from genotype_keepers k, ACC_Accession ac, ALL_Allele a
-                where k._Allele_key = ac._Object_key
-                        and ac._MGIType_key = 11
+                from ACC_Accession ac %s
+                where ac._MGIType_key = 11
                         and ac.private = 0
                         and ac.preferred = 1
                         and ac._LogicalDB_key = 1
-                        and k._Allele_key = a._Allele_key
-                ''' % (accID)
+                        and exists (select 1 from genotype_keepers k
+                                where k._Allele_key = ac._Object_key
+                                )
+                        %s
+                ''' % (accID, debugFrom, debugWhere)
         ALLELE_MAP = KeyMap(alleleCmd, '_Object_key', 'accID')
 
-        # map from reference keys to their Jnum IDs
-        jnumCmd = '''
-                select distinct r._Refs_key, r.jnumID
-                from VOC_Annot va, VOC_Evidence ve, BIB_Citation_Cache r
-                where va._AnnotType_key = %d
-                and va._Annot_key = ve._Annot_key
-                and ve._Refs_key = r._Refs_key
-                ''' % CURRENT_ANNOT_TYPE
-        JNUM_MAP = KeyMap(jnumCmd, '_Refs_key', 'jnumID')
-
-        # map from evidence term keys to their abbreviations
-        evidenceCmd = '''
-                select distinct vt._Term_key, vt.abbreviation
-                from VOC_AnnotType vat, VOC_Term vt
-                where vat._AnnotType_key = %d
-                and vat._EvidenceVocab_key = vt._Vocab_key
-                ''' % CURRENT_ANNOT_TYPE
-        EVIDENCE_MAP = KeyMap(evidenceCmd, '_Term_key', 'abbreviation')
+        # J: numbers, evidence codes, and user logins are resolved by
+        # _getEvidence() as part of each batch query
 
         # map from qualifier term keys to their terms
 
@@ -879,10 +1019,6 @@ def _initializeKeyMaps():
                 ''' % CURRENT_ANNOT_TYPE
         QUALIFIER_MAP = KeyMap(qualifierCmd, '_Term_key', 'term')
 
-        # map from user key to user login name (small data set - get them all)
-        userCmd = '''select u._User_key, u.login from MGI_User u'''
-        USER_MAP = KeyMap(userCmd, '_User_key', 'login') 
-
         # map from property term key to property name
         propertyCmd = '''
                 select distinct t._Term_key, t.term
@@ -891,7 +1027,7 @@ def _initializeKeyMaps():
                 ''' % os.environ['ANNOTPROPERTY']
         PROPERTY_MAP = KeyMap(propertyCmd, '_Term_key', 'term')
 
-        _stamp('15:Initialized 7 key maps\n')
+        _stamp('15:Initialized 4 key maps\n')
 
         return
 
@@ -908,6 +1044,9 @@ def _initialize():
         db.useOneConnection(1)
         #_cleanupTempTables()
 
+        _buildTestGenotypes()
+        _buildAccessionCache()
+        _buildAnnotatedGenotypes()
         _countAllelePerGenotype('GXD_AlleleGenotype')
 
         _buildKeepersTable()
@@ -915,6 +1054,7 @@ def _initialize():
         _indexKeepersTable()
 
         _buildScratchPad() 
+        _buildAlleleSubtypeFlags()
         _identifyReporterTransgenes()
         _removeConditionalGenotypes()
         _removeReporterTransgenes()
@@ -930,6 +1070,7 @@ def _initialize():
 
         _getAlleleMetaData()
         _initializeKeyMaps()
+        _buildBatchTable()
 
         # And now, we have globals with counts of annotations for each allele
         # and an ordered list of allele keys.  (to use in grouping data when
@@ -947,28 +1088,26 @@ def _getNextAlleleBatch():
         # allele has more than the allowed number of annotations, then we will
         # return that allele only and let it be processed solo.
 
-        global ANNOTATION_COUNTS, ALLELE_KEYS, LAST_ALLELE_KEY_INDEX
+        global LAST_ALLELE_KEY_INDEX
 
-        maxIndex = len(ALLELE_KEYS) - 1
-
-        if LAST_ALLELE_KEY_INDEX == None:
+        if LAST_ALLELE_KEY_INDEX is None:
                 startIndex = 0
         else:
                 startIndex = LAST_ALLELE_KEY_INDEX + 1
 
-        if startIndex > maxIndex:
+        if startIndex >= len(ALLELE_KEYS):
                 return None, None
 
-        endIndex = startIndex
-
-        total = ANNOTATION_COUNTS[ALLELE_KEYS[startIndex]]
+        # ANNOTATION_TOTALS is strictly increasing, so the batch ends just
+        # before the first allele that would bring the batch total up to
+        # MAX_ANNOTATIONS (but always includes the starting allele)
 
-        while (total < MAX_ANNOTATIONS) and (endIndex < maxIndex):
-                i = endIndex + 1
-                total = total + ANNOTATION_COUNTS[ALLELE_KEYS[i]]
+        if startIndex == 0:
+                limit = MAX_ANNOTATIONS
+        else:
+                limit = ANNOTATION_TOTALS[startIndex - 1] + MAX_ANNOTATIONS
 
-                if (total < MAX_ANNOTATIONS):
-                        endIndex = i 
+        endIndex = max(startIndex, bisect.bisect_left(ANNOTATION_TOTALS, limit) - 1)
 
         LAST_ALLELE_KEY_INDEX = endIndex
 
@@ -980,189 +1119,180 @@ def _makeDictionary (rows, keyField):
         # 'keyField'.
         # Returns: { value : [ row 1, row 2, ... ] }
 
-        out = {}
+        out = collections.defaultdict(list)
         for row in rows:
-                #print(type(keyField))
-                #print(type(row))
-                if not row.has_key(keyField):
-                        raise Error('Missing key (%s) in row: %s' % (
-                                keyField, str(row)))
-                key = row[keyField]
+                out[row[keyField]].append(row)
 
-                if key not in out:
-                        out[key] = []
+        # behave as a plain dictionary for callers (no silent inserts)
+        out.default_factory = None
+        return out
 
-                out[key].append(row)
+def _makeAlleleDictionary (rows, keyField):
+        # take the given list of database 'rows' (each containing a
+        # _Allele_key) and group them in one pass by allele key and then by
+        # the value in each row corresponding to 'keyField'.
+        # Returns: { allele key : { value : [ row 1, row 2, ... ] } }
 
-        return out
+        byAllele = {}
+        for row in rows:
+                byAllele.setdefault(row['_Allele_key'], {}).setdefault(row[keyField], []).append(row)
+        return byAllele
 
-def _getAnnotations (startAllele, endAllele):
-        # get all rows from VOC_Annot which can be rolled up to alleles between
-        # the given 'startAllele' and 'endAllele', inclusive.  
-        # Returns: { allele key : [ annotation rows ] }
+def _buildBatchTable():
+        # build the batch_annots table, which will contain the allele/annotation
+        # pairs for the current batch of alleles.  Note that the table will
+        # not be populated by this method; see _fillBatchTable().
 
-        _stamp('17:_getAnnotations')
+        _stamp('15:_buildBatchTable')
 
         cmd = '''
-                select distinct k._Allele_key, a.*
-                from genotype_keepers k, VOC_Annot a
-                where k._Genotype_key = a._Object_key
-                and a._AnnotType_key in (%d)
-                and k._Allele_key >= %d
-                and k._Allele_key <= %d
-                ''' % ( CURRENT_ANNOT_TYPE, startAllele, endAllele)
-
-        return _makeDictionary (db.sql(cmd, 'auto'), '_Allele_key')
+                create temp table batch_annots (
+                        _Allele_key int not null,
+                        _Annot_key int not null
+                )
+                '''
+        db.sql(cmd, None)
+        db.sql('create index batch_annots_idx on batch_annots (_Annot_key)', None)
+        _stamp('\n')
 
-def _getEvidence (startAllele, endAllele):
-        # get all the rows from VOC_Evidence for annotations which can be
-        # rolled up to alleles between the given 'startAllele' and 'endAllele',
-        # inclusive.
-        # Returns: { _Annot_key : [ evidence rows ] }
+        return
 
-        _stamp('18:_getEvidence')
+def _executePrepared (name, cmd, args = (), resultType = 'auto'):
+        # run the prepared statement 'name' with the given 'args', first
+        # preparing it from 'cmd' if this is its first use in the session.
+        # The per-batch queries differ only in their parameters, so they are
+        # parsed and planned once rather than once per batch.
 
-        cmd = '''
-                select distinct k._Allele_key, e.*
-                from genotype_keepers k, VOC_Annot a, VOC_Evidence e
-                where k._Genotype_key = a._Object_key
-                and a._AnnotType_key in (%d)
-                and k._Allele_key >= %d
-                and k._Allele_key <= %d
-                and a._Annot_key = e._Annot_key
-                ''' % (CURRENT_ANNOT_TYPE, startAllele, endAllele)
+        if name not in PREPARED:
+                db.sql('prepare %s as %s' % (name, cmd), None)
+                PREPARED.add(name)
 
-        results = db.sql(cmd, 'auto')
+        if args:
+                return db.sql('execute %s (%s)' % (name, ', '.join(map(str, args))), resultType)
+        return db.sql('execute %s' % name, resultType)
 
-        return _makeDictionary (results, '_Annot_key'), results
+def _fillBatchTable (startAllele, endAllele):
+        # refill the batch_annots table with the annotations which can be
+        # rolled up to alleles between the given 'startAllele' and
+        # 'endAllele', inclusive, so the annotation, evidence, property, and
+        # note queries for the batch join to it rather than each re-deriving
+        # the batch from genotype_keepers and VOC_Annot.  Each allele/
+        # annotation pair is stored once, and the follow-up queries only join
+        # on primary keys from here, so they do not need their own distinct.
 
-def _getEvidenceProperties (startAllele, endAllele, rawEvidence):
-        # get all the properties from VOC_Evidence_Property for evidence
-        # records, which are for annotations which can be rolled up to alleles
-        # between the given 'startAllele' and 'endAllele', inclusive.
-        # Returns: { _AnnotEvidence_key : [ property rows ] }
+        _stamp('16:_fillBatchTable')
 
-        _stamp('19:_getEvidenceProperties')
+        db.sql('truncate table batch_annots', None)
 
         cmd = '''
-                select distinct k._Allele_key, e._Annot_key, p.*
-                from genotype_keepers k, VOC_Annot a, VOC_Evidence e, VOC_Evidence_Property p
+                insert into batch_annots
+                select distinct k._Allele_key, a._Annot_key
+                from genotype_keepers k, VOC_Annot a
                 where k._Genotype_key = a._Object_key
-                and a._AnnotType_key in (%d)
-                and k._Allele_key >= %d
-                and k._Allele_key <= %d
-                and a._Annot_key = e._Annot_key
-                and e._AnnotEvidence_key = p._AnnotEvidence_key
-                order by p._AnnotEvidence_key, p.stanza, p.sequenceNum
-                ''' % ( CURRENT_ANNOT_TYPE, startAllele, endAllele)
-
-        properties = db.sql(cmd, 'auto')
-        _stamp('19:Retrieved properties: %d' % len(properties))
-
-        # need to go through the evidence records and add an extra property
-        # for each one, to refer back to the _Annot_key of the annotation
-        # from which this one is derived.  Note:  These evidence records are
-        # all for source annotations (not derived ones), so none of them
-        # would already have a _SourceAnnot_key property.
-
-        byEvidenceKey = _makeDictionary (properties, '_AnnotEvidence_key') 
-
-        evidenceKeys = list(byEvidenceKey.keys())
-        evidenceKeys.sort()
-
-        added = 0
-
-        # tracks (evidence key, allele key) pairs - indicates when we have a
-        # source annotation property associated with that allele through the
-        # specified evidence record.
-        evidenceAllelePairs = {}
-
-        for evidenceKey in evidenceKeys:
-                rows = byEvidenceKey[evidenceKey]
-
-                # get maximum sequence number for properties tied to this
-                # evidenceKey, then increment for the new property
-
-                seqNum = max([x['sequenceNum'] for x in rows])
-                if not seqNum:
-                        seqNum = 1
-                else:
-                        seqNum = seqNum + 1
-
-                seqRows = []
-                for row in rows:
-                        alleleKey = row['_Allele_key']
-
-                        # if we don't already have a source row involving this
-                        # allele, then copy the current property row as a
-                        # starting point, then update the copy with necessary
-                        # altered values
-
-                        pair = (evidenceKey, alleleKey)
-                        if pair in evidenceAllelePairs:
-                                continue
-
-                        evidenceAllelePairs[pair] = True
-                        seqNum = seqNum + 1
-
-                        newProperty = copy.copy(row)
-
-                        newProperty['_PropertyTerm_key'] = SOURCE_ANNOT_KEY
-                        newProperty['sequenceNum'] = seqNum
-                        newProperty['value'] = newProperty['_Annot_key']
+                and a._AnnotType_key = %d
+                and k._Allele_key >= $1
+                and k._Allele_key <= $2
+                ''' % CURRENT_ANNOT_TYPE
 
-                        seqRows.append(newProperty)
+        _executePrepared('fill_batch_annots', cmd, (startAllele, endAllele), None)
+        return
 
-                # and add the new source property
-                byEvidenceKey[evidenceKey] = rows + seqRows
-                added = added + len(seqRows)
+def _getAnnotations ():
+        # get all rows from VOC_Annot for the current batch (batch_annots)
+        # Returns: { allele key : [ annotation rows ] }
 
-        _stamp('19:add source key properties for records with existing properties: %d' % added)
+        _stamp('17:_getAnnotations')
 
-        # need to handle evidence rows which had no properties previously
+        cmd = '''
+                select b._Allele_key, a._Annot_key, a._Term_key, a._Qualifier_key
+                from batch_annots b, VOC_Annot a
+                where b._Annot_key = a._Annot_key
+                '''
 
-        ct = 0
-        for row in rawEvidence:
-                evidenceKey = row['_AnnotEvidence_key']
-                alleleKey = row['_Allele_key']
+        return _makeDictionary (_executePrepared('get_annotations', cmd), '_Allele_key')
 
-                pair = (evidenceKey, alleleKey)
+def _getEvidence ():
+        # get all the rows from VOC_Evidence for annotations in the current
+        # batch (batch_annots).  Each row also carries its J: number (jnumID), evidence
+        # code (abbreviation), and modified-by user (login), so finalize()
+        # does not need to map those keys itself.
+        # Returns: { allele key : { _Annot_key : [ evidence rows ] } }
 
-                # Add a source row if the annotation had no evidence at all.
+        _stamp('18:_getEvidence')
 
-                if pair not in evidenceAllelePairs:
-                        r = {
-                                '_Allele_key' : alleleKey,
-                                '_AnnotEvidence_key' : evidenceKey,
-                                '_PropertyTerm_key' : SOURCE_ANNOT_KEY,
-                                'stanza' : 1,
-                                'sequenceNum' : 1,
-                                'value' : row['_Annot_key'],
-                                '_CreatedBy_key' : row['_CreatedBy_key'],
-                                '_ModifiedBy_key' : row['_ModifiedBy_key'],
-                                'creation_date' : row['creation_date'],
-                                'modification_date' : row['modification_date'],
-                                }
+        cmd = '''
+                select b._Allele_key, e._Annot_key, e._AnnotEvidence_key, e.inferredFrom,
+                        r.jnumID, et.abbreviation, u.login
+                from batch_annots b, VOC_Evidence e
+                        left outer join BIB_Citation_Cache r on (e._Refs_key = r._Refs_key)
+                        left outer join VOC_Term et on (e._EvidenceTerm_key = et._Term_key)
+                        left outer join MGI_User u on (e._ModifiedBy_key = u._User_key)
+                where b._Annot_key = e._Annot_key
+                '''
 
-                        if evidenceKey not in byEvidenceKey:
-                                byEvidenceKey[evidenceKey] = [ r ]
-                        else:
-                                byEvidenceKey[evidenceKey].append(r)
+        results = _executePrepared('get_evidence', cmd)
+        _stamp('18:returned evidence rows: %d' % len(results))
 
-                        evidenceAllelePairs[pair] = True
-                        ct = ct + 1
+        return _makeAlleleDictionary (results, '_Annot_key')
 
-        _stamp('19:add source key properties for records with no existing properties: %d' % ct)
-        _stamp('19:add source key properties in all: %d' % len(byEvidenceKey))
+def _getEvidenceProperties ():
+        # get all the properties from VOC_Evidence_Property for evidence
+        # records, which are for annotations in the current batch
+        # (batch_annots).
+        #
+        # Each evidence record also gets an extra property for each of its
+        # alleles, to refer back to the _Annot_key of the annotation from
+        # which the derived one comes.  These evidence records are all for
+        # source annotations (not derived ones), so none of them would
+        # already have a _SourceAnnot_key property.  The database builds the
+        # extra property (second half of the union):  it is numbered after
+        # the existing properties and sorts after all of them, so once
+        # _buildPropertiesValue groups consecutive rows by stanza it joins
+        # the existing stanza if there is only one, forms its own last
+        # stanza if there are several, and is stanza 1 if there are no
+        # other properties.
+        #
+        # Returns: { allele key : { _AnnotEvidence_key : [ property rows ] } }
 
-        return byEvidenceKey
+        _stamp('19:_getEvidenceProperties')
 
-def _getNotes (startAllele, endAllele):
+        cmd = '''
+                select b._Allele_key, e._Annot_key, p._AnnotEvidence_key,
+                        p._PropertyTerm_key, p.stanza, p.sequenceNum, p.value,
+                        0 as is_source
+                from batch_annots b, VOC_Evidence e, VOC_Evidence_Property p
+                where b._Annot_key = e._Annot_key
+                and e._AnnotEvidence_key = p._AnnotEvidence_key
+                union all
+                select b._Allele_key, e._Annot_key, e._AnnotEvidence_key,
+                        %d as _PropertyTerm_key,
+                        coalesce(m.min_stanza, 1) as stanza,
+                        coalesce(m.max_sequence_num, 0) + row_number() over (
+                                partition by e._AnnotEvidence_key
+                                order by b._Allele_key) as sequenceNum,
+                        e._Annot_key::text as value,
+                        1 as is_source
+                from batch_annots b, VOC_Evidence e
+                        left outer join lateral (select min(p.stanza) as min_stanza,
+                                        max(p.sequenceNum) as max_sequence_num
+                                from VOC_Evidence_Property p
+                                where p._AnnotEvidence_key = e._AnnotEvidence_key
+                        ) m on true
+                where b._Annot_key = e._Annot_key
+                order by _AnnotEvidence_key, is_source, stanza, sequenceNum
+                ''' % SOURCE_ANNOT_KEY
+
+        properties = _executePrepared('get_evidence_properties', cmd)
+        _stamp('19:Retrieved properties (including source key properties): %d' % len(properties))
+
+        return _makeAlleleDictionary (properties, '_AnnotEvidence_key')
+
+def _getNotes ():
         # get notes from MGI_Note for evidence records, which
-        # are for annotations which can be rolled up to alleles between the
-        # given 'startAllele' and 'endAllele', inclusive.
-        # Returns: { _AnnotEvidence_key : { note key : { record from database } } }
-        # handle basic data for each note
+        # are for annotations in the current batch (batch_annots).
+        # Only the text of each note is kept, rather than its whole record
+        # from the database, as that is all finalize() needs.
+        # Returns: { allele key : { _AnnotEvidence_key : { note key : note text } } }
 
         _stamp('20:_getNotes')
 
@@ -1170,120 +1300,51 @@ def _getNotes (startAllele, endAllele):
         # BACKGROUND_SENSITIVITY_NOTE = 1015	# note type key for background;sensitivity notes for evidence
 
         cmd = '''
-                select distinct k._Allele_key, n.*
-                from genotype_keepers k,
-                        VOC_Annot a,
+                select b._Allele_key, n._Object_key, n._Note_key, n.note
+                from batch_annots b,
                         VOC_Evidence e,
                         MGI_Note n
-                where k._Genotype_key = a._Object_key
-                        and a._AnnotType_key in (%d)
-                        and k._Allele_key >= %d
-                        and k._Allele_key <= %d
-                        and a._Annot_key = e._Annot_key
+                where b._Annot_key = e._Annot_key
                         and e._AnnotEvidence_key = n._Object_key
                         and n._NoteType_key in (1008, 1015)             -- general note/background;sensitivity note
-                order by n._Object_key''' % (CURRENT_ANNOT_TYPE, startAllele, endAllele)
+                order by n._Object_key'''
 
-        results = db.sql(cmd, 'auto')
+        results = _executePrepared('get_notes', cmd)
 
-        notes = {}		# evidence key -> notes
-        noteToEvidence = {}	# note key -> evidence key
+        notes = {}		# allele key -> evidence key -> notes
 
         for row in results:
-                evidenceKey = row['_Object_key']
-                noteKey = row['_Note_key']
-
-                if evidenceKey in notes:
-                        notes[evidenceKey][noteKey] = row
-                else:
-                        notes[evidenceKey] = { noteKey : row }
-
-                noteToEvidence[noteKey] = evidenceKey
+                notes.setdefault(row['_Allele_key'], {}).setdefault(row['_Object_key'], {})[row['_Note_key']] = row['note']
 
         #print(notes)
         return notes
 
-def _splitByAllele (results):
-        # take a dictionary keyed by some other field, with values being a
-        # list of data rows (each containing a _Allele_key), and group those
-        # rows into a dictionary with the allele keys at the top level, as:
-        # 	{ allele key : { original key : [ original rows ] }
-        # This is so we can easily determine which rows go with which alleles.
-
-        byAllele = {}
-
-        originalKeys = list(results.keys())
-        for key in originalKeys:
-                for row in results[key]:
-                        alleleKey = row['_Allele_key']
-
-                        if alleleKey not in byAllele:
-                                byAllele[alleleKey] = { key : [ row ] }
-
-                        elif key not in byAllele[alleleKey]:
-                                byAllele[alleleKey][key] = [ row ]
-
-                        else:
-                                byAllele[alleleKey][key].append (row)
-        return byAllele
-
-def _splitNotesByAllele (notes):
-        # takes dictionary of results, as returned by _getNotes() and splits
-        # them up by allele, returning a dictionary where a allele key
-        # goes to a dictionary of those evidence records for that allele.
-
-        byAllele = {}
-
-        for evidenceKey in list(notes.keys()):
-                noteKeys = list(notes[evidenceKey].keys())
-
-                # just need to get the allele from the first note
-
-                if noteKeys:
-                        noteKey = noteKeys[0]
-                        alleleKey = notes[evidenceKey][noteKey]['_Allele_key']
-
-                # Each evidence key is only for one allele, so we don't need
-                # to worry about overwriting an existing evidenceKey for a
-                # allele.
-
-                if alleleKey not in byAllele:
-                        byAllele[alleleKey] = { evidenceKey : notes[evidenceKey] }
-                else:
-                        byAllele[alleleKey][evidenceKey] = notes[evidenceKey]
-        return byAllele
-
-def _getAlleles (startAllele, endAllele):
-        # get a list of Allele objects (including annotations, evidence, and
+def _buildAlleles (startAllele, endAllele):
+        # build a deque of Allele objects (including annotations, evidence, and
         # properties) for all alleles between (and including) the two given
         # allele keys
 
         _stamp('16:_getAlleles')
 
+        _fillBatchTable(startAllele, endAllele)
+
         # allele key -> list of annotation rows
-        annotations = _getAnnotations(startAllele, endAllele)
+        annotations = _getAnnotations()
 
         # allele key -> annotation key -> evidence rows 
-        evidenceResults, rawEvidence =_getEvidence(startAllele, endAllele)
-        evidence = _splitByAllele(evidenceResults)
-        _stamp('16:returned rawEvidence rows: %d' % len(rawEvidence))
+        evidence = _getEvidence()
 
         # allele key -> evidence key -> property rows
-        properties = _splitByAllele(_getEvidenceProperties(startAllele, endAllele, rawEvidence))
+        properties = _getEvidenceProperties()
         _stamp('16:received properties for alleles: %d' % len(properties))
 
-        # allele key -> evidence key -> note rows
-        notes = _splitNotesByAllele(_getNotes(startAllele, endAllele))
+        # allele key -> evidence key -> note key -> note text
+        notes = _getNotes()
         _stamp('16:received notes for alleles: %d' % len(notes))
 
-        # Returns: { _AnnotEvidence_key : { note key : { record from database } } }
+        alleles = collections.deque()	# Allele objects to return, in order
 
-        alleleKeys = list(annotations.keys())
-        alleleKeys.sort()
-
-        alleles = []		# list of Allele object to return
-
-        for alleleKey in alleleKeys:
+        for alleleKey in sorted(annotations):
                 allele = Allele(alleleKey)
                 allele.setAnnotations(annotations[alleleKey])
 
@@ -1296,7 +1357,23 @@ def _getAlleles (startAllele, endAllele):
 
                 alleles.append(allele)
 
-        gc.collect()
+        return alleles
+
+def _getAlleles (startAllele, endAllele):
+        # get a deque of Allele objects for all alleles between (and including)
+        # the two given allele keys.  Every row and container built for the
+        # batch stays alive until its allele is written, so automatic garbage
+        # collection is suspended while building the batch (it would only
+        # rescan live objects).  The rows, dictionaries, and Allele objects
+        # form no reference cycles, so they are freed by reference counting
+        # as each allele is written, with no full collection needed.
+
+        gc.disable()
+        try:
+                alleles = _buildAlleles(startAllele, endAllele)
+        finally:
+                gc.enable()
+
         return alleles
 
 ###--- public functions ---###
@@ -1328,7 +1405,7 @@ def getNextAllele():
         if not ALLELES_TO_DO:
                 startAllele, endAllele = _getNextAlleleBatch()
 
-                if startAllele == None:
+                if startAllele is None:
                         return None
 
                 ALLELES_TO_DO = _getAlleles (startAllele, endAllele)
@@ -1336,12 +1413,9 @@ def getNextAllele():
         if not ALLELES_TO_DO:
                 return None
 
-        # pop the first allele off the list and return it
-
-        allele = ALLELES_TO_DO[0]
-        ALLELES_TO_DO = ALLELES_TO_DO[1:]
+        # pop the first allele off the queue and return it
 
-        return allele
+        return ALLELES_TO_DO.popleft()
 
 def addTiming(s):
         # add a timing point to the profiler, identified by item 's'
@@ -141,25 +141,15 @@ else:
 if annotType in ('diseaseMarker', 'mpMarker'):
         marker = rollupmarkerlib.getNextMarker()
         while marker:
-                for annot in marker.getAnnotations():
-                        # skip; no entrez gene id
-                        if annot[1] == None:
-                                continue
-                        elif DEBUG == True:
-                                annotFile.write(annotLine % tuple(annot))
-                        # mouse
-                        elif annot[9] == 'MGI':
-                                annotFile.write(annotLine % tuple(annot))
-                        # non-mouse
-                        else:
-                                annotFile2.write(annotLine % tuple(annot))
+                # markers with no entrez gene id are skipped; mouse markers
+                # go to annotFile and non-mouse markers to annotFile2
+                marker.writeAnnotations(annotFile, annotFile2, annotLine)
                 marker = rollupmarkerlib.getNextMarker()
 
 elif annotType in ('diseaseAllele', 'mpAllele'):
         allele = rollupallelelib.getNextAllele()
         while allele:
-                for annot in allele.getAnnotations():
-                        annotFile.write(annotLine % tuple(annot))
+                allele.writeAnnotations(annotFile, annotLine)
                 allele = rollupallelelib.getNextAllele()
         
 if finalize():
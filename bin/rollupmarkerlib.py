@@ -30,13 +30,18 @@
 import gc
 import os
 import db
-import copy
+import itertools
+import bisect
 import mgi_utils
 
 ###--- globals ---###
 
 db.setTrace()
-Error = 'rollupmarkerlib.Error'
+
+class Error(Exception):
+        # exception raised by this module
+        pass
+
 DEBUG = False
 
 MAX_ANNOTATIONS = 5000		# maximum number of annotations to cache in
@@ -48,6 +53,11 @@ MP_GENOTYPE = 1002		# Mammalian Phenotype/Genotype annotation type
 NO_PHENOTYPIC_ANALYSIS = 293594	# term key for 'no phenotypic analysis' term
 SOURCE_ANNOT_KEY = None		# term key for _SourceAnnot_key property
 
+# annotation type -> term key for its _SourceAnnot_key property
+SOURCE_ANNOT_KEYS = { DO_GENOTYPE : 13611348, MP_GENOTYPE : 13576001 }
+
+NOTE_WHITESPACE = str.maketrans('\n\t', '  ')	# newlines and tabs -> spaces, for notes
+
 GT_ROSA = 37270			# marker key for Gt(ROSA)26Sor marker
 HPRT = 9936			# marker key for Hprt marker
 COL1A1 = 1092			# marker key for Col1a1 marker
@@ -56,13 +66,15 @@ DOCKING_SITES = [ GT_ROSA, HPRT, COL1A1 ]	# loci that can be generally knocked i
 
 INITIALIZED = False		# have we finished initializing this module?
 
-ANNOTATION_COUNTS = {}		# marker key -> count of rolled-up annotations
-
 MARKER_KEYS = []		# ordered list of marker keys
 
+ANNOTATION_TOTALS = []		# running total of rolled-up annotations, parallel to MARKER_KEYS
+
 LAST_MARKER_KEY_INDEX = None	# index into MARKER_KEYS of last marker key which had its details loaded
 
-MARKERS_TO_DO = []		# list of markers loaded and waiting to be processed
+PREPARED = set()		# names of statements prepared in this session
+
+MARKERS_TO_DO = iter(())	# iterator over the markers of the current batch
 
 TERM_MAP = None			# KeyMap for term key -> term ID
 MARKER_MAP = None		# KeyMap for marker key -> marker or entrezgene ID
@@ -71,15 +83,11 @@ JNUM_MAP = None			# KeyMap for refs key -> J: number
 EVIDENCE_MAP = None		# KeyMap for evidence key -> evidence abbrev.
 QUALIFIER_MAP = None		# KeyMap for qualifier key -> qualifier term
 USER_MAP = None			# KeyMap for user key -> user
-PROPERTY_MAP = None		# KeyMap for property key -> property name
 
 # no testing
-testSQL = ""
+testGenotypes = []
 
-#testSQL = '''
-#and exists (select 1 from ACC_Accession testg 
-#where gag._genotype_key = testg._object_key and testg._mgitype_key = 12 
-#and testg.accid in (
+#testGenotypes = [
 #'MGI:3811643',
 #'MGI:3794207',
 #'MGI:6402641',
@@ -96,9 +104,10 @@ testSQL = ""
 #'MGI:2671158',
 #'MGI:3700949',
 #'MGI:3522576'
-#)
-#)
-#'''
+#]
+
+# extra where clause restricting genotypes to testGenotypes; set by _buildTestGenotypes()
+testSQL = ""
 
 ###--- classes ---###
 
@@ -108,15 +117,19 @@ class KeyMap:
         # Does: populates the mapping from the database and provides easy
         #	access to look up the value for each key
 
-        def __init__ (self, query, keyField, valueField):
+        __slots__ = ('mapping',)
+
+        def __init__ (self, query, keyField, valueField, rows = None):
                 # instantiate a new key mapping using the given SQL 'query',
                 # using values for 'keyField' as the keys and values for
-                # 'valueField' for their corresponding values
+                # 'valueField' for their corresponding values.  If 'rows'
+                # is given, they are the already-fetched results of 'query',
+                # so one fetch can feed more than one KeyMap.
 
-                self.mapping = {}
+                if rows is None:
+                        rows = db.sql(query, 'auto')
 
-                for row in db.sql(query, 'auto'):
-                        self.mapping[row[keyField]] = row[valueField]
+                self.mapping = { row[keyField] : row[valueField] for row in rows }
                 return
 
         def __len__ (self):
@@ -127,9 +140,7 @@ class KeyMap:
                 # return the value corresponding to the given key, or None
                 # if there is no value for that 'key'
 
-                if key in self.mapping:
-                        return self.mapping[key]
-                return None
+                return self.mapping.get(key)
 
 class Marker:
         # Is: a single marker from the database
@@ -141,6 +152,9 @@ class Marker:
         #	object, you can no longer call any set*() methods.  
         #       This is due to the need to prepare the data (as noted above).
 
+        __slots__ = ('finalized', 'markerKey', 'annotations', 'evidence',
+                'evidenceProperties', 'notes', 'finalAnnotations')
+
         def __init__ (self, markerKey):
                 # constructor; initializes object for marker with given key
 
@@ -156,7 +170,7 @@ class Marker:
                 # annotation key -> list of evidence rows
                 self.evidence = {}
 
-                # evidence key -> list of property rows
+                # evidence key -> properties value
                 self.evidenceProperties = {}
 
                 # evidence key -> { note key : { note record } }
@@ -171,62 +185,26 @@ class Marker:
                 # concatenate the various notes together from noteDict
                 # for the given 'evidenceKey'
 
-                notes = ''
-                if evidenceKey in self.notes:
-                        for (noteKey, noteRow) in list(self.notes[evidenceKey].items()):
-                                if notes:
-                                        notes = notes.strip() + ' '
-                                notes = notes + noteRow['note']
-
-                return notes.replace('\n', ' ').replace('\t', ' ').strip()
-
-        def _buildPropertiesValue (self, evidenceKey):
-                # build a str.to encapsulate the various properties in the manner expected by the annotload
+                noteRows = self.notes.get(evidenceKey)
+                if not noteRows:
+                        return ''
 
-                stanzas = []
+                # trailing whitespace is trimmed from each note, and blank
+                # notes are skipped, so the notes are separated by one space
 
-                if evidenceKey in self.evidenceProperties:
-                        lastStanza = None
+                notes = [ noteRow['note'].rstrip() for noteRow in noteRows.values() ]
 
-                        for row in self.evidenceProperties[evidenceKey]:
-                                stanza = row['stanza']
+                return ' '.join([ note for note in notes if note ]).translate(NOTE_WHITESPACE).strip()
 
-                                # if we have a change in stanza, then add a
-                                # new stanza to our list of stanzas
-
-                                if lastStanza != stanza:
-                                        lastStanza = stanza
-                                        stanzas.append([])
-
-                                # compose our clause and add it to the most
-                                # recent stanza
-
-                                clause = '%s&=&%s' % ( PROPERTY_MAP.get(row['_PropertyTerm_key']), row['value'] )
-                                stanzas[-1].append(clause)
-
-                # finally, use &==& to separate clauses within a stanza, and
-                # use &===& to separate the stanzas
-
-                x = []
-                for stanza in stanzas:
-                        x.append('&==&'.join(stanza))
-
-                return '&===&'.join(x)
-
-        def finalize (self):
-                # The finalize() method takes this marker object from its
-                # original state (old primary keys, old annotation types) and
-                # converts them to rows appropriate to be loaded as new
-                # records by the annotation loader.  This can be called
-                # multiple times, as it will be a no-op if the marker is
-                # already finalized.
-
-                if self.finalized:
-                        return
+        def _buildRows (self):
+                # generator; converts this marker object from its original
+                # state (old primary keys, old annotation types) to rows
+                # appropriate to be loaded as new records by the annotation
+                # loader, yielding one row at a time
 
                 # The input file for the annotation loader allows up to eleven
-                # fields per line.  We will generate rows in that format for
-                # self.finalAnnotations, specifically for our data set:
+                # fields per line.  We will generate rows in that format,
+                # specifically for our data set:
                 #    1. vocab term ID
                 #    2. marker ID
                 #    3. J: num
@@ -239,7 +217,22 @@ class Marker:
                 #   10. empty -- defaults to MGI IDs for markers
                 #   11. properties -- can be empty
 
-                self.finalAnnotations = []
+                # bind the key map dictionaries (and the per-evidence note
+                # and properties lookups) to locals once, as they are
+                # consulted for every annotation and evidence row below.
+                # Properties values are built by _getEvidenceProperties() in
+                # the manner expected by the annotload.
+
+                termMap = TERM_MAP.mapping
+                markerMap = MARKER_MAP.mapping
+                logicaldbMap = LOGICALDB_MAP.mapping
+                qualifierMap = QUALIFIER_MAP.mapping
+                evidenceMap = EVIDENCE_MAP.mapping
+                jnumMap = JNUM_MAP.mapping
+                userMap = USER_MAP.mapping
+
+                concatenateNotes = self._concatenateNotes
+                getProperties = self.evidenceProperties.get
 
                 for annotRow in self.annotations:
                         annotKey = annotRow['_Annot_key']
@@ -248,65 +241,72 @@ class Marker:
                                 # skip annotations to this term
                                 continue
 
-                        termID = TERM_MAP.get(annotRow['_Term_key'])
-                        markerID = MARKER_MAP.get(annotRow['_Marker_key'])
-                        logicaldb = LOGICALDB_MAP.get(annotRow['_Marker_key'])
-                        qualifier = QUALIFIER_MAP.get( annotRow['_Qualifier_key'])
+                        evidRows = self.evidence.get(annotKey)
+                        if evidRows is None:
+                                continue
 
-                        if qualifier == None:
-                                qualifier = ''
+                        termID = termMap.get(annotRow['_Term_key'])
+                        markerID = markerMap.get(annotRow['_Marker_key'])
 
-                        if annotKey not in self.evidence:
-                                continue
+                        # in debug mode only the term and marker IDs are
+                        # written, so skip building the rest of the row
 
-                        for evidRow in self.evidence[annotKey]:
-                                evidKey = evidRow['_AnnotEvidence_key']
-                                inferredFrom = evidRow['inferredFrom']
-                                evidenceCode = EVIDENCE_MAP.get( evidRow['_EvidenceTerm_key'])
-                                jnumID = JNUM_MAP.get( evidRow['_Refs_key'])
-                                user = USER_MAP.get(evidRow['_ModifiedBy_key'])
+                        if DEBUG:
+                                for evidRow in evidRows:
+                                        yield (termID, markerID)
+                                continue
 
-                                if inferredFrom == None:
-                                        inferredFrom = ''
+                        logicaldb = logicaldbMap.get(annotRow['_Marker_key'])
+                        qualifier = qualifierMap.get(annotRow['_Qualifier_key']) or ''
 
-                                if qualifier == None:
-                                        qualifier = ''
+                        for evidRow in evidRows:
+                                evidKey = evidRow['_AnnotEvidence_key']
 
                                 # concatenate all notes together into a single
                                 # mega-note, as the annotation loader can only
                                 # load a single General note and these are
-                                # only for searching anyway.
-
-                                notes = self._concatenateNotes(evidKey)
-
-                                # build properties str.to include any properties
-
-                                properties = self._buildPropertiesValue(evidKey)
-
-                                if DEBUG:
-                                        row = [
-                                                termID,
-                                                markerID
-                                                ]
-                                else:
-                                        row = [
-                                                termID,
-                                                markerID,
-                                                jnumID,
-                                                evidenceCode,
-                                                inferredFrom,
-                                                qualifier,
-                                                user,
-                                                '',
-                                                notes,
-                                                logicaldb,
-                                                properties
-                                                ]
-
-                                self.finalAnnotations.append(row) 
+                                # only for searching anyway.  Build properties
+                                # str.to include any properties.
+
+                                yield (
+                                        termID,
+                                        markerID,
+                                        jnumMap.get(evidRow['_Refs_key']),
+                                        evidenceMap.get(evidRow['_EvidenceTerm_key']),
+                                        evidRow['inferredFrom'] or '',
+                                        qualifier,
+                                        userMap.get(evidRow['_ModifiedBy_key']),
+                                        '',
+                                        concatenateNotes(evidKey),
+                                        logicaldb,
+                                        getProperties(evidKey) or ''
+                                        )
+
+                return
+
+        def _release (self):
+                # drop the input data, which is no longer needed once this
+                # marker is finalized
+                self.annotations = None
+                self.evidence = None
+                self.evidenceProperties = None
+                self.notes = None
+                return
+
+        def finalize (self):
+                # The finalize() method collects the rows from _buildRows()
+                # into self.finalAnnotations.  This can be called multiple
+                # times, as it will be a no-op if the marker is already
+                # finalized.
+
+                if self.finalized:
+                        return
+
+                self.finalAnnotations = list(self._buildRows())
 
                 # finished translating old records to new records
                 self.finalized = True
+                self._release()
                 return
 
         def checkWriteable (self, setWhat):
@@ -341,6 +341,41 @@ class Marker:
                 self.finalize()
                 return self.finalAnnotations
 
+        def writeAnnotations (self, fp, nonMouseFp, template):
+                # writes this marker's annotation rows, formatting each with
+                # the given line 'template', without collecting them in
+                # self.finalAnnotations.  Every row for a marker carries the
+                # same marker ID and logical db, so the marker is routed as a
+                # whole:  skipped if it has no ID (a non-mouse marker with no
+                # Entrez Gene ID), else written to 'fp' for mouse markers
+                # (and for every marker in DEBUG mode) or to 'nonMouseFp' for
+                # non-mouse markers.  Raises Error for a non-mouse marker if
+                # there is no 'nonMouseFp' to write it to.  Finalizes the
+                # marker.
+
+                markerID = MARKER_MAP.get(self.markerKey)
+
+                if markerID is not None:
+                        if DEBUG or LOGICALDB_MAP.get(self.markerKey) == 'MGI':
+                                out = fp
+                        elif nonMouseFp is None:
+                                s = 'No non-mouse output file for marker: %d' % self.markerKey
+                                raise Error(s)
+                        else:
+                                out = nonMouseFp
+
+                        if self.finalized:
+                                rows = self.finalAnnotations
+                        else:
+                                rows = self._buildRows()
+
+                        out.writelines(map(template.__mod__, rows))
+
+                self.finalAnnotations = []
+                self.finalized = True
+                self._release()
+                return
+
 ###--- private functions ---###
 
 def _stamp (s):
@@ -371,15 +406,44 @@ def _deleteScratchpad():
                 _stamp('after delete from scratchpad')
                 _stampResults('scratchpad', 'order by gaccid, maccid')
 
-        # re-create genotype_pair_counts from scratchpad
-        _countAllelePairsPerGenotype('scratchpad')
-
 def _getCount(table):
+        # return the number of rows in 'table'; each call is a full count of
+        # the table, so the row-count log messages are only written in DEBUG
         results = db.sql('select count(1) as get_count from %s' % table, 'auto')
         if not results:
                 return 0
         return results[0]['get_count']
 
+def _buildTestGenotypes():
+        # when testing, collect the genotype keys for the MGI IDs listed in
+        # testGenotypes into a temp table (test_genotypes) and point testSQL
+        # at it, so the genotype queries join to a small indexed table rather
+        # than re-checking ACC_Accession against a literal list each time
+
+        global testSQL
+
+        if not testGenotypes:
+                return
+
+        _stamp('0:_buildTestGenotypes/test_genotypes')
+
+        cmd = '''
+                select distinct a._Object_key as _Genotype_key
+                into temp table test_genotypes
+                from ACC_Accession a
+                where a._MGIType_key = 12
+                and a.accid in (%s)
+                ''' % ','.join(["'%s'" % x for x in testGenotypes])
+
+        db.sql(cmd, None)
+        db.sql('create unique index tmp_test_genotypes on test_genotypes (_Genotype_key)', None)
+        if DEBUG:
+                _stamp('0:test_genotypes : %d\n' % _getCount('test_genotypes'))
+
+        testSQL = 'and gag._Genotype_key in (select _Genotype_key from test_genotypes)'
+
+        return
+
 def _identifyExpressesComponent():
         # builds a has_expresses_component temp table with (genotype key, # allele key) pairs 
         # for those genotypes and alleles with 'expresses  component' relationships.  
@@ -406,7 +470,8 @@ def _identifyExpressesComponent():
         db.sql(cmd, None)
         db.sql('create index hec1 on has_expresses_component (_Genotype_key)', None)
         db.sql('create index hec2 on has_expresses_component (_Allele_key)', None)
-        _stamp('1:has_expresses_component : %d\n' % (_getCount('has_expresses_component')))
+        if DEBUG:
+                _stamp('1:has_expresses_component : %d\n' % (_getCount('has_expresses_component')))
         _stampResults('has_expresses_component')
 
         return
@@ -438,7 +503,8 @@ def _identifyMutationInvolves():
         db.sql('create index hmi1 on has_mutation_involves (_Genotype_key)', None)
         db.sql('create index hmi2 on has_mutation_involves (_Allele_key)', None)
         db.sql('create index hmi3 on has_mutation_involves (_Marker_key)', None)
-        _stamp('1a:mutation_involves : %d\n' % (_getCount('has_mutation_involves')))
+        if DEBUG:
+                _stamp('1a:mutation_involves : %d\n' % (_getCount('has_mutation_involves')))
         _stampResults('has_mutation_involves')
 
         return
@@ -455,12 +521,13 @@ def _countAllelePairsPerGenotype(table):
                 cmd = '''
                         select gag._Genotype_key, count(1) as pair_count
                         into temp table genotype_pair_counts
-                        from GXD_AlleleGenotype gag
-                        where exists (select 1 from VOC_Annot v
-                                where v._AnnotType_key in (%d)
+                        from GXD_AlleleGenotype gag,
+                                (select distinct v._Object_key
+                                from VOC_Annot v
+                                where v._AnnotType_key = %d
                                 and v._Term_key != %d
-                                and v._Object_key = gag._Genotype_key
-                                )
+                                ) va
+                        where gag._Genotype_key = va._Object_key
                         %s
                         group by gag._Genotype_key
                         ''' % (CURRENT_ANNOT_TYPE, NO_PHENOTYPIC_ANALYSIS, testSQL)
@@ -474,7 +541,8 @@ def _countAllelePairsPerGenotype(table):
 
         db.sql(cmd, None)
         db.sql('create index tmp_by_count on genotype_pair_counts (pair_count, _Genotype_key)', None)
-        _stamp('2:genotype_pair_counts : %d\n' % _getCount('genotype_pair_counts'))
+        if DEBUG:
+                _stamp('2:genotype_pair_counts : %d\n' % _getCount('genotype_pair_counts'))
 
         return
 
@@ -570,7 +638,8 @@ def _keepNaturallySimpleGenotypes():
                 '''
 
         db.sql(cmd, None)
-        _stamp('4:add naturally simple genotypes: %d\n' % _getCount('genotype_keepers'))
+        if DEBUG:
+                _stamp('4:add naturally simple genotypes: %d\n' % _getCount('genotype_keepers'))
         _addKeeper()
 
         return
@@ -613,7 +682,8 @@ def _identifyReporterTransgenes():
 
         db.sql(cmd, None)
         db.sql('create unique index tmp_reportertg on reporter_transgenes (_Allele_key)', None)
-        _stamp('7:built reporter_transgenes table rows: %d\n' % _getCount('reporter_transgenes'))
+        if DEBUG:
+                _stamp('7:built reporter_transgenes table rows: %d\n' % _getCount('reporter_transgenes'))
 
         return
 
@@ -634,7 +704,7 @@ def _identifyTransactivators():
         cmd = '''
                 select distinct a._Allele_key
                 into temp table transactivators
-                from all_allele a, voc_annot t
+                from ALL_Allele a
                 where a._Allele_Type_key = 847126         -- transgenic
                         and exists (select 1 from VOC_Annot v
                                 where a._Allele_key = v._Object_key
@@ -650,7 +720,8 @@ def _identifyTransactivators():
 
         db.sql(cmd, None)
         db.sql('create unique index tmp_transactivators on transactivators (_Allele_key)', None)
-        _stamp('10:built transactivators table rows: %d\n' % _getCount('transactivators'))
+        if DEBUG:
+                _stamp('10:built transactivators table rows: %d\n' % _getCount('transactivators'))
 
         return
 
@@ -698,7 +769,8 @@ def _buildScratchPad():
 
         db.sql(cmd, None)
         db.sql('create index scratch_alleles on scratchpad (_Allele_key)', None)
-        _stamp('6:built scratchpad table rows: %d\n' % _getCount('scratchpad'))
+        if DEBUG:
+                _stamp('6:built scratchpad table rows: %d\n' % _getCount('scratchpad'))
         _deleteScratchpad()
 
         return
@@ -711,7 +783,8 @@ def _removeConditionalGenotypes():
         _stamp('8.2:allele attribute Recombinase = true')
         _stamp('8.3:allele attribute "inserted expressed sequence" = false')
 
-        before = _getCount('scratchpad')
+        if DEBUG:
+                before = _getCount('scratchpad')
 
         cmd = '''
                 delete from scratchpad p
@@ -735,7 +808,8 @@ def _removeConditionalGenotypes():
                '''
 
         db.sql(cmd, None)
-        _stamp('8:delete recombinase alleles from scratchpad: %d\n' % (before - _getCount('scratchpad'))) 
+        if DEBUG:
+                _stamp('8:delete recombinase alleles from scratchpad: %d\n' % (before - _getCount('scratchpad'))) 
         _deleteScratchpad()
 
         return
@@ -744,10 +818,12 @@ def _cleanupTempTables():
         # drop any temp tables that we're done with
 
         tables = [ 
+                'test_genotypes',
                 'has_expresses_component',
                 'has_mutation_involves',
                 'genotype_pair_counts',
                 'genotype_keepers',
+                'batch_annots',
                 'reporter_transgenes',
                 'transactivators',
                 'scratchpad',
@@ -775,10 +851,12 @@ def _removeReporterTransgenes():
 
         _stamp('9:_removeReporterTransgenes/scratchpad')
         _stamp('9:reporter_transgenes = true')
-        before = _getCount('scratchpad')
+        if DEBUG:
+                before = _getCount('scratchpad')
         #_stampResults('reporter_transgenes')
         db.sql('delete from scratchpad p where exists (select 1 from reporter_transgenes r where p._allele_key = r._allele_key)', None)
-        _stamp('9:delete reporter transgenes from scratchpad: %d\n' % (before - _getCount('scratchpad')))
+        if DEBUG:
+                _stamp('9:delete reporter transgenes from scratchpad: %d\n' % (before - _getCount('scratchpad')))
         _deleteScratchpad()
 
         return 
@@ -789,9 +867,11 @@ def _removeTransactivators():
         _stamp('11:_removeTransactivators/scratchpad')
         _stamp('11:transactivators = true')
         #_stampResults('transactivators')
-        before = _getCount('scratchpad')
+        if DEBUG:
+                before = _getCount('scratchpad')
         db.sql('delete from scratchpad p where exists (select 1 from transactivators t where p._allele_key = t._allele_key)', None)
-        _stamp('11:delete transactivators from scratchpad: %d\n' % ( before - _getCount('scratchpad')) )
+        if DEBUG:
+                _stamp('11:delete transactivators from scratchpad: %d\n' % ( before - _getCount('scratchpad')) )
         _deleteScratchpad()
 
         return 
@@ -811,7 +891,8 @@ def _identifyWildTypeAlleles():
 
         db.sql(cmd, None)
         db.sql('create unique index wt_alleles on wildtype_alleles (_Allele_key)', None)
-        _stamp('12:wildtype_alleles table rows: %d\n' % _getCount('wildtype_alleles'))
+        if DEBUG:
+                _stamp('12:wildtype_alleles table rows: %d\n' % _getCount('wildtype_alleles'))
 
         return
 
@@ -820,10 +901,12 @@ def _removeWildTypeAllelesFromScratchPad():
 
         _stamp('13:_removeWildTypeAllelesFromScratchPad/scratchpad')
         _stamp('13:wildtype_alleles = true')
-        before = _getCount('scratchpad')
+        if DEBUG:
+                before = _getCount('scratchpad')
         _stampResults('wildtype_alleles')
         db.sql('delete from scratchpad p where exists (select 1 from wildtype_alleles w where p._allele_key = w._allele_key)', None)
-        _stamp('13:delete wild-type from scratchpad: %d\n' % ( before - _getCount('scratchpad')) )
+        if DEBUG:
+                _stamp('13:delete wild-type from scratchpad: %d\n' % ( before - _getCount('scratchpad')) )
         _deleteScratchpad()
 
         return
@@ -921,10 +1004,10 @@ def _collectMarkerSets():
                 db.sql(c4, None)
                 db.sql(c5, None)
 
-                _stamp('14:built table of %s genotype/marker pairs rows: %d' % (name, _getCount(tbl1)) )
-                _stamp('14:built table of %s genotype/marker counts rows: %d' % (name, _getCount(tbl2)) )
-
                 if DEBUG:
+                        _stamp('14:built table of %s genotype/marker pairs rows: %d' % (name, _getCount(tbl1)) )
+                        _stamp('14:built table of %s genotype/marker counts rows: %d' % (name, _getCount(tbl2)) )
+
                         results = db.sql('''
                                 select a.accid, m.symbol, t.* 
                                 from %s t, MRK_Marker m, ACC_Accession a
@@ -970,7 +1053,8 @@ def _handleMultipleMarkers():
 
         _stamp('15:_handleMultipleMarkers/rule #2 : mouse transgene, 1 EC, 0 MI')
 
-        before = _getCount('genotype_keepers')
+        if DEBUG:
+                before = _getCount('genotype_keepers')
 
         template = '''
                 insert into genotype_keepers
@@ -1037,11 +1121,14 @@ def _handleMultipleMarkers():
         otherCmd = template % ('nt._Marker_key', 'nt._Organism_key', 'nt.symbol', 'nt._Marker_key')
         db.sql(transgeneCmd, None)
         db.sql(otherCmd, None)
-        _stamp('15:add rows to genotype_keepers for transgene rule A: %d' % (_getCount('genotype_keepers') - before))
+        if DEBUG:
+                _stamp('15:add rows to genotype_keepers for transgene rule A: %d' % (_getCount('genotype_keepers') - before))
 
-        beforeSP = _getCount('scratchpad')
+        if DEBUG:
+                beforeSP = _getCount('scratchpad')
         db.sql('delete from scratchpad where _Genotype_key in (select _Genotype_key from trad_ct where marker_count > 1)', None)
-        _stamp('15:delete multi-marker genotypes from scratchpad: %d\n' % ( beforeSP - _getCount('scratchpad')))
+        if DEBUG:
+                _stamp('15:delete multi-marker genotypes from scratchpad: %d\n' % ( beforeSP - _getCount('scratchpad')))
 
         return
 
@@ -1050,9 +1137,8 @@ def _handleMutationInvolves():
 
         _stamp('16:_handleMutationInvolves/rule #3 : mutation involves')
 
-        results = db.sql('select * from mi_ct', 'auto')
-        _stamp('select * from mi_ct: %d\n' % len(results))
-        #_stamp(results)
+        if DEBUG:
+                _stamp('select * from mi_ct: %d\n' % _getCount('mi_ct'))
 
         #
         # important : check scratchpad by genotype AND allele
@@ -1206,7 +1292,8 @@ def _handleMutationInvolves():
                 for r in results:
                         _stamp(r)
 
-        before = _getCount('genotype_keepers')
+        if DEBUG:
+                before = _getCount('genotype_keepers')
         cmd = '''
                 insert into genotype_keepers
                 select s._Genotype_key, \'rule #3 : non-transgene clause\', s._Marker_key, s._Organism_key, s.symbol, s.gaccid, s.maccid
@@ -1214,10 +1301,12 @@ def _handleMutationInvolves():
                 where s._genotype_key = mi1._genotype_key
                 '''
         db.sql(cmd, None)
-        _stamp('16:added rows to genotype_keepers from mi1: %d\n' % (_getCount('genotype_keepers') - before))
+        if DEBUG:
+                _stamp('16:added rows to genotype_keepers from mi1: %d\n' % (_getCount('genotype_keepers') - before))
         _addKeeper()
 
-        before = _getCount('genotype_keepers')
+        if DEBUG:
+                before = _getCount('genotype_keepers')
         cmd = '''
                 insert into genotype_keepers
                 select s._Genotype_key, \'rule #3 : transgene clause\', mi2._Marker_key, mi2._Organism_key, mi2.symbol, s.gaccid, s.maccid
@@ -1225,10 +1314,12 @@ def _handleMutationInvolves():
                 where s._genotype_key = mi2._genotype_key
                 '''
         db.sql(cmd, None)
-        _stamp('16:added rows to genotype_keepers from mi2: %d\n' % (_getCount('genotype_keepers') - before))
+        if DEBUG:
+                _stamp('16:added rows to genotype_keepers from mi2: %d\n' % (_getCount('genotype_keepers') - before))
         _addKeeper()
 
-        before = _getCount('genotype_keepers')
+        if DEBUG:
+                before = _getCount('genotype_keepers')
         cmd = '''
                 insert into genotype_keepers
                 select s._Genotype_key, \'rule #3 : docking site clause\', mi3._Marker_key, mi3._Organism_key, mi3.symbol, s.gaccid, s.maccid
@@ -1236,15 +1327,18 @@ def _handleMutationInvolves():
                 where s._genotype_key = mi3._genotype_key
                 '''
         db.sql(cmd, None)
-        _stamp('16:added rows to genotype_keepers from mi3: %d\n' % (_getCount('genotype_keepers') - before))
+        if DEBUG:
+                _stamp('16:added rows to genotype_keepers from mi3: %d\n' % (_getCount('genotype_keepers') - before))
         _addKeeper()
 
-        before2 = _getCount('scratchpad')
+        if DEBUG:
+                before2 = _getCount('scratchpad')
         db.sql('delete from scratchpad where _Genotype_key in (select _Genotype_key from mi_ct)', None)
         db.sql('delete from scratchpad where _Genotype_key in (select _Genotype_key from mi1)', None)
         db.sql('delete from scratchpad where _Genotype_key in (select _Genotype_key from mi2)', None)
         db.sql('delete from scratchpad where _Genotype_key in (select _Genotype_key from mi3)', None)
-        _stamp('16:delete rows from scratchpad due to mutation involves rule: %d\n' % (before2 - _getCount('scratchpad')) )
+        if DEBUG:
+                _stamp('16:delete rows from scratchpad due to mutation involves rule: %d\n' % (before2 - _getCount('scratchpad')) )
         _deleteScratchpad()
 
         return
@@ -1313,19 +1407,25 @@ def _handleTransgenes():
                         )
                 '''
 
-        ct1 = _getCount('genotype_keepers')
+        if DEBUG:
+                ct1 = _getCount('genotype_keepers')
         db.sql(cmdTg, None)
-        ct2 = _getCount('genotype_keepers')
-        _stamp('17:add rows to genotype_keepers for transgenes: %d' % ( ct2 - ct1))
+        if DEBUG:
+                ct2 = _getCount('genotype_keepers')
+                _stamp('17:add rows to genotype_keepers for transgenes: %d' % ( ct2 - ct1))
         db.sql(cmdECMouse, None)
-        _stamp('17:add rows to genotype_keepers for expressed components mouse: %d' % (_getCount('genotype_keepers') - ct2))
+        if DEBUG:
+                _stamp('17:add rows to genotype_keepers for expressed components mouse: %d' % (_getCount('genotype_keepers') - ct2))
         db.sql(cmdECNonMouse, None)
-        _stamp('17:add rows to genotype_keepers for expressed components non-mouse: %d' % (_getCount('genotype_keepers') - ct2))
+        if DEBUG:
+                _stamp('17:add rows to genotype_keepers for expressed components non-mouse: %d' % (_getCount('genotype_keepers') - ct2))
         _addKeeper()
 
-        ct3 = _getCount('scratchpad')
+        if DEBUG:
+                ct3 = _getCount('scratchpad')
         db.sql(cmdDel, None)
-        _stamp('17:delete rows from scratchpad for transgenes: %d\n' % ( ct3 - _getCount('scratchpad')) )
+        if DEBUG:
+                _stamp('17:delete rows from scratchpad for transgenes: %d\n' % ( ct3 - _getCount('scratchpad')) )
         _deleteScratchpad()
 
         return
@@ -1354,9 +1454,11 @@ def _handleDockingSites():
                         and ec._RelationshipTerm_key = 12438346 -- expresses_component
                         and s._Genotype_key = ec._Genotype_key
                 ''' % (docking_sites)
-        ct = _getCount('genotype_keepers')
+        if DEBUG:
+                ct = _getCount('genotype_keepers')
         db.sql(cmd, None)
-        _stamp('18:add rows to genotype_keepers for docking sites rule #6: %d' % (_getCount('genotype_keepers') - ct))
+        if DEBUG:
+                _stamp('18:add rows to genotype_keepers for docking sites rule #6: %d' % (_getCount('genotype_keepers') - ct))
         _addKeeper()
 
         _stamp('18:_handleDockingSites/rule #9 : docking site, Expresses No Components')
@@ -1376,15 +1478,19 @@ def _handleDockingSites():
                                 )
 
                  ''' % (HPRT, COL1A1)
-        ct = _getCount('genotype_keepers')
+        if DEBUG:
+                ct = _getCount('genotype_keepers')
         db.sql(cmd, None)
-        _stamp('18:add rows to genotype_keepers for docking sites rule #9: %d' % (_getCount('genotype_keepers') - ct))
+        if DEBUG:
+                _stamp('18:add rows to genotype_keepers for docking sites rule #9: %d' % (_getCount('genotype_keepers') - ct))
         _addKeeper()
 
         cmd = '''delete from scratchpad where _Marker_key in (%s)''' % docking_sites
-        ct = _getCount('scratchpad')
+        if DEBUG:
+                ct = _getCount('scratchpad')
         db.sql(cmd, None)
-        _stamp('18:delete rows from scratchpad for docking sites: %d\n' % ( ct - _getCount('scratchpad')) )
+        if DEBUG:
+                _stamp('18:delete rows from scratchpad for docking sites: %d\n' % ( ct - _getCount('scratchpad')) )
         _deleteScratchpad()
 
         return
@@ -1441,12 +1547,15 @@ def _handleOtherSingles():
                         and ec._Organism_key = 1
                 '''
 
-        ct1 = _getCount('genotype_keepers')
+        if DEBUG:
+                ct1 = _getCount('genotype_keepers')
         db.sql(cmd1, None)
-        ct2 = _getCount('genotype_keepers')
-        _stamp('19:add rows to genotype_keepers for singles with no EC: %d' % (ct2 - ct1))
+        if DEBUG:
+                ct2 = _getCount('genotype_keepers')
+                _stamp('19:add rows to genotype_keepers for singles with no EC: %d' % (ct2 - ct1))
         db.sql(cmd2, None)
-        _stamp('19:add rows to genotype_keepers for self-expressing singles: %d\n' % (_getCount('genotype_keepers') - ct2))
+        if DEBUG:
+                _stamp('19:add rows to genotype_keepers for self-expressing singles: %d\n' % (_getCount('genotype_keepers') - ct2))
         _addKeeper()
         db.sql('drop table if exists exclude_genotypes', None);
 
@@ -1456,28 +1565,36 @@ def _removeNullsAndGtRosa():
         # finally, delete all the genotypes associated with Gt(ROSA)26Sor
 
         _stamp('20:_removeNullsAndGtRosa')
-        ct1 = _getCount('genotype_keepers')
+        if DEBUG:
+                ct1 = _getCount('genotype_keepers')
         db.sql('delete from genotype_keepers where _Marker_key = %d' % GT_ROSA, None)
-        ct2 = _getCount('genotype_keepers')
-        _stamp('20:delete genotypes associated with Gt(ROSA)26Sor: %d' % (ct1 - ct2))
+        if DEBUG:
+                ct2 = _getCount('genotype_keepers')
+                _stamp('20:delete genotypes associated with Gt(ROSA)26Sor: %d' % (ct1 - ct2))
         db.sql('delete from genotype_keepers where _Marker_key is null', None)
-        _stamp('20:delete genotypes associated with null markers: %d\n' % (ct2 - _getCount('genotype_keepers')))
+        if DEBUG:
+                _stamp('20:delete genotypes associated with null markers: %d\n' % (ct2 - _getCount('genotype_keepers')))
         _deleteKeeper()
 
         return
 
 def _getMarkerMetaData():
-        # populate global variables with counts of annotations for each marker
-        # and an ordered list of marker keys to process.
+        # populate global variables with an ordered list of marker keys to
+        # process and the running total of their annotation counts.
 
-        global ANNOTATION_COUNTS, MARKER_KEYS, LAST_MARKER_KEY_INDEX
+        global ANNOTATION_TOTALS, MARKER_KEYS, LAST_MARKER_KEY_INDEX
 
         _stamp('22:_getMarkerMetaData')
 
-        ANNOTATION_COUNTS = {}
-        MARKER_KEYS = []
         LAST_MARKER_KEY_INDEX = None
 
+        # genotype_keepers is complete at this point; temp tables are never
+        # analyzed automatically, so gather statistics once for the planner
+        # before the count query and the per-batch range scans over
+        # gk_marker (_Marker_key, _Genotype_key)
+
+        db.sql('analyze genotype_keepers', None)
+
         cmd = '''
                 select k._Marker_key, count(1) as annotation_count
                 from genotype_keepers k, VOC_Annot a
@@ -1485,19 +1602,19 @@ def _getMarkerMetaData():
                 and a._AnnotType_key in (%s)
                 and a._Term_key != %d
                 group by k._Marker_key
+                order by k._Marker_key
                 ''' % (CURRENT_ANNOT_TYPE, NO_PHENOTYPIC_ANALYSIS)
 
         results = db.sql(cmd, 'auto')
-        for row in results:
-                ANNOTATION_COUNTS[row['_Marker_key']] = row['annotation_count']
 
         if DEBUG:
                 for r in results:
                         _stamp(r)
                 _stamp('\n')
 
-        MARKER_KEYS = list(ANNOTATION_COUNTS.keys())
-        MARKER_KEYS.sort()
+        MARKER_KEYS = [ row['_Marker_key'] for row in results ]
+        ANNOTATION_TOTALS = list(itertools.accumulate(
+                row['annotation_count'] for row in results))
 
         _stamp('22:Retrieved annotation counts for %d markers\n' % len(MARKER_KEYS)) 
 
@@ -1508,7 +1625,7 @@ def _initializeKeyMaps():
         # respective values
 
         global TERM_MAP, MARKER_MAP, LOGICALDB_MAP, JNUM_MAP, EVIDENCE_MAP
-        global QUALIFIER_MAP, USER_MAP, PROPERTY_MAP, CURRENT_ANNOT_TYPE
+        global QUALIFIER_MAP, USER_MAP, CURRENT_ANNOT_TYPE
 
         _stamp('23:_initializeKeyMaps')
 
@@ -1558,8 +1675,9 @@ def _initializeKeyMaps():
                 and k._Marker_key = m._Marker_key
                 and m._Organism_key != 1
                 ''' % (accID, accID)
-        MARKER_MAP = KeyMap(markerCmd, '_Object_key', 'accID')
-        LOGICALDB_MAP = KeyMap(markerCmd, '_Object_key', 'logicaldb')
+        markerRows = db.sql(markerCmd, 'auto')
+        MARKER_MAP = KeyMap(markerCmd, '_Object_key', 'accID', markerRows)
+        LOGICALDB_MAP = KeyMap(markerCmd, '_Object_key', 'logicaldb', markerRows)
 
         # map from reference keys to their Jnum IDs
         jnumCmd = '''
@@ -1594,13 +1712,7 @@ def _initializeKeyMaps():
         userCmd = '''select u._User_key, u.login from MGI_User u'''
         USER_MAP = KeyMap(userCmd, '_User_key', 'login') 
 
-        # map from property term key to property name
-        propertyCmd = '''
-                select distinct t._Term_key, t.term
-                from VOC_Term t
-                where t._Vocab_key = %s
-                ''' % os.environ['ANNOTPROPERTY']
-        PROPERTY_MAP = KeyMap(propertyCmd, '_Term_key', 'term')
+        # property term names are resolved by _getEvidenceProperties()
 
         _stamp('23:Initialized 7 key maps\n')
 
@@ -1619,6 +1731,7 @@ def _initialize():
         db.useOneConnection(1)
         #_cleanupTempTables()
 
+        _buildTestGenotypes()
         _identifyExpressesComponent()
         _identifyMutationInvolves()
         _countAllelePairsPerGenotype('GXD_AlleleGenotype')
@@ -1639,6 +1752,10 @@ def _initialize():
         _identifyWildTypeAlleles()
         _removeWildTypeAllelesFromScratchPad()
 
+        # re-create genotype_pair_counts from the pruned scratchpad, for the
+        # mutation involves rule (the only later step that reads it)
+        _countAllelePairsPerGenotype('scratchpad')
+
         _collectMarkerSets()
 
         _handleMultipleMarkers()
@@ -1655,12 +1772,20 @@ def _initialize():
 
         _getMarkerMetaData()
         _initializeKeyMaps()
+        _buildBatchTable()
 
         # And now, we have globals with counts of annotations for each marker
         # and an ordered list of marker keys.  (to use in grouping data when
         # pulling data from the database)  And, we have initialized our key
         # generators for the tables we will be loading data into.
 
+        # The key maps and metadata live for the rest of the run, so move
+        # them out of the collector's generations; collections during the
+        # marker batches then only scan the per-batch rows and objects.
+
+        gc.collect()
+        gc.freeze()
+
         INITIALIZED = True
 
         return 
@@ -1672,218 +1797,212 @@ def _getNextMarkerBatch():
         # marker has more than the allowed number of annotations, then we will
         # return that marker only and let it be processed solo.
 
-        global ANNOTATION_COUNTS, MARKER_KEYS, LAST_MARKER_KEY_INDEX
-
-        maxIndex = len(MARKER_KEYS) - 1
+        global LAST_MARKER_KEY_INDEX
 
-        if LAST_MARKER_KEY_INDEX == None:
+        if LAST_MARKER_KEY_INDEX is None:
                 startIndex = 0
         else:
                 startIndex = LAST_MARKER_KEY_INDEX + 1
 
-        if startIndex > maxIndex:
+        if startIndex >= len(MARKER_KEYS):
                 return None, None
 
-        endIndex = startIndex
-
-        total = ANNOTATION_COUNTS[MARKER_KEYS[startIndex]]
+        # ANNOTATION_TOTALS is strictly increasing, so the batch ends just
+        # before the first marker that would bring the batch total up to
+        # MAX_ANNOTATIONS (but always includes the starting marker)
 
-        while (total < MAX_ANNOTATIONS) and (endIndex < maxIndex):
-                i = endIndex + 1
-                total = total + ANNOTATION_COUNTS[MARKER_KEYS[i]]
+        if startIndex == 0:
+                limit = MAX_ANNOTATIONS
+        else:
+                limit = ANNOTATION_TOTALS[startIndex - 1] + MAX_ANNOTATIONS
 
-                if (total < MAX_ANNOTATIONS):
-                        endIndex = i 
+        endIndex = max(startIndex, bisect.bisect_left(ANNOTATION_TOTALS, limit) - 1)
 
         LAST_MARKER_KEY_INDEX = endIndex
 
         return MARKER_KEYS[startIndex], MARKER_KEYS[endIndex]
 
-def _makeDictionary (rows, keyField):
-        # take the given list of database 'rows' and turn them into a
-        # dictionary using as keys the value in each row corresponding to
-        # 'keyField'.
-        # Returns: { value : [ row 1, row 2, ... ] }
-
-        out = {}
-        for row in rows:
-                #print(type(keyField))
-                #print(type(row))
-                if not row.has_key(keyField):
-                        raise Error('Missing key (%s) in row: %s' % (keyField, str(row)))
-                key = row[keyField]
+def _buildBatchTable():
+        # build the batch_annots table, which will contain the marker/annotation
+        # pairs for the current batch of markers.  Note that the table will
+        # not be populated by this method; see _fillBatchTable().
 
-                if key not in out:
-                        out[key] = []
+        _stamp('23:_buildBatchTable')
 
-                out[key].append(row)
+        cmd = '''
+                create temp table batch_annots (
+                        _Marker_key int not null,
+                        _Annot_key int not null
+                )
+                '''
+        db.sql(cmd, None)
+        db.sql('create index batch_annots_idx on batch_annots (_Annot_key)', None)
+        _stamp('\n')
 
-        return out
+        return
 
-def _getAnnotations (startMarker, endMarker):
-        # get all rows from VOC_Annot which can be rolled up to markers between
-        # the given 'startMarker' and 'endMarker', inclusive.  
-        # Returns: { marker key : [ annotation rows ] }
+def _executePrepared (name, cmd, args = (), resultType = 'auto'):
+        # run the prepared statement 'name' with the given 'args', first
+        # preparing it from 'cmd' if this is its first use in the session.
+        # The per-batch queries differ only in their parameters, so they are
+        # parsed and planned once rather than once per batch.
 
-        _stamp('25:_getAnnotations')
+        if name not in PREPARED:
+                db.sql('prepare %s as %s' % (name, cmd), None)
+                PREPARED.add(name)
 
-        cmd = '''
-                select distinct k._Marker_key, a.*
-                from genotype_keepers k, VOC_Annot a
-                where k._Genotype_key = a._Object_key
-                and a._AnnotType_key in (%d)
-                and a._Term_key != %d
-                and k._Marker_key >= %d
-                and k._Marker_key <= %d
-                ''' % ( CURRENT_ANNOT_TYPE, NO_PHENOTYPIC_ANALYSIS, startMarker, endMarker)
+        if args:
+                return db.sql('execute %s (%s)' % (name, ', '.join(map(str, args))), resultType)
+        return db.sql('execute %s' % name, resultType)
 
-        return _makeDictionary (db.sql(cmd, 'auto'), '_Marker_key')
+def _fillBatchTable (startMarker, endMarker):
+        # refill the batch_annots table with the annotations which can be
+        # rolled up to markers between the given 'startMarker' and
+        # 'endMarker', inclusive, so the annotation, evidence, property, and
+        # note queries for the batch join to it rather than each re-deriving
+        # the batch from genotype_keepers and VOC_Annot
 
-def _getEvidence (startMarker, endMarker):
-        # get all the rows from VOC_Evidence for annotations which can be
-        # rolled up to markers between the given 'startMarker' and 'endMarker',
-        # inclusive.
-        # Returns: { _Annot_key : [ evidence rows ] }
+        _stamp('24:_fillBatchTable')
 
-        _stamp('26:_getEvidence')
+        db.sql('truncate table batch_annots', None)
 
         cmd = '''
-                select distinct k._Marker_key, e.*
-                from genotype_keepers k, VOC_Annot a, VOC_Evidence e
+                insert into batch_annots
+                select distinct k._Marker_key, a._Annot_key
+                from genotype_keepers k, VOC_Annot a
                 where k._Genotype_key = a._Object_key
                 and a._AnnotType_key in (%d)
                 and a._Term_key != %d
-                and k._Marker_key >= %d
-                and k._Marker_key <= %d
-                and a._Annot_key = e._Annot_key
-                ''' % (CURRENT_ANNOT_TYPE, NO_PHENOTYPIC_ANALYSIS, startMarker, endMarker)
-
-        results = db.sql(cmd, 'auto')
-
-        return _makeDictionary (results, '_Annot_key'), results
+                and k._Marker_key >= $1
+                and k._Marker_key <= $2
+                ''' % ( CURRENT_ANNOT_TYPE, NO_PHENOTYPIC_ANALYSIS)
 
-def _getEvidenceProperties (startMarker, endMarker, rawEvidence):
-        # get all the properties from VOC_Evidence_Property for evidence records, which are for annotations which can be rolled up to markers
-        # between the given 'startMarker' and 'endMarker', inclusive.
-        # Returns: { _AnnotEvidence_key : [ property rows ] }
+        _executePrepared('fill_batch_annots', cmd, (startMarker, endMarker), None)
+        return
 
-        _stamp('27:_getEvidenceProperties')
+def _getAnnotationsAndEvidence ():
+        # get the rows from VOC_Annot and VOC_Evidence for the current batch
+        # (batch_annots) in one query, as one row per evidence record
+        # carrying its annotation's columns.  An annotation with no evidence
+        # produces no rows for the annotload, so it does not need to be
+        # fetched on its own; the first row for each annotation key serves
+        # as that annotation's row.  batch_annots holds each marker/
+        # annotation pair once, and the joins are on primary keys, so no
+        # distinct is needed.
+        # Returns: ({ marker key : [ annotation rows ] },
+        #       { marker key : { _Annot_key : [ evidence rows ] } },
+        #       count of evidence rows)
+
+        _stamp('25:_getAnnotationsAndEvidence')
 
         cmd = '''
-                select distinct k._Marker_key, e._Annot_key, p.*
-                from genotype_keepers k, VOC_Annot a, VOC_Evidence e, VOC_Evidence_Property p
-                where k._Genotype_key = a._Object_key
-                and a._AnnotType_key in (%d)
-                and a._Term_key != %d
-                and k._Marker_key >= %d
-                and k._Marker_key <= %d
+                select b._Marker_key, a._Annot_key, a._Term_key, a._Qualifier_key,
+                        e._AnnotEvidence_key, e._Refs_key, e._EvidenceTerm_key,
+                        e.inferredFrom, e._ModifiedBy_key
+                from batch_annots b, VOC_Annot a, VOC_Evidence e
+                where b._Annot_key = a._Annot_key
                 and a._Annot_key = e._Annot_key
-                and e._AnnotEvidence_key = p._AnnotEvidence_key
-                order by p._AnnotEvidence_key, p.stanza, p.sequenceNum
-                ''' % ( CURRENT_ANNOT_TYPE, NO_PHENOTYPIC_ANALYSIS, startMarker, endMarker)
-
-        properties = db.sql(cmd, 'auto')
-        _stamp('26:Retrieved properties: %d' % len(properties))
-
-        # need to go through the evidence records and add an extra property
-        # for each one, to refer back to the _Annot_key of the annotation
-        # from which this one is derived.  Note:  These evidence records are
-        # all for source annotations (not derived ones), so none of them
-        # would already have a _SourceAnnot_key property.
-
-        byEvidenceKey = _makeDictionary (properties, '_AnnotEvidence_key') 
-
-        evidenceKeys = list(byEvidenceKey.keys())
-        evidenceKeys.sort()
-
-        added = 0
+                '''
 
-        # tracks (evidence key, marker key) pairs - indicates when we have a
-        # source annotation property associated with that marker through the
-        # specified evidence record.
-        evidenceMarkerPairs = {}
+        results = _executePrepared('get_annotations_evidence', cmd)
 
-        for evidenceKey in evidenceKeys:
-                rows = byEvidenceKey[evidenceKey]
+        annotations = {}	# marker key -> annotation rows
+        evidence = {}		# marker key -> annotation key -> evidence rows
 
-                # get maximum sequence number for properties tied to this
-                # evidenceKey, then increment for the new property
+        for row in results:
+                markerKey = row['_Marker_key']
+                annotKey = row['_Annot_key']
+                byAnnot = evidence.setdefault(markerKey, {})
 
-                seqNum = max([x['sequenceNum'] for x in rows])
-                if not seqNum:
-                        seqNum = 1
+                if annotKey in byAnnot:
+                        byAnnot[annotKey].append(row)
                 else:
-                        seqNum = seqNum + 1
+                        byAnnot[annotKey] = [ row ]
+                        annotations.setdefault(markerKey, []).append(row)
 
-                seqRows = []
-                for row in rows:
-                        markerKey = row['_Marker_key']
-
-                        # if we don't already have a source row involving this marker, 
-                        # then copy the current property row as a starting point, 
-                        # then update the copy with necessary altered values
-
-                        pair = (evidenceKey, markerKey)
-                        if pair in evidenceMarkerPairs:
-                                continue
+        return annotations, evidence, len(results)
 
-                        evidenceMarkerPairs[pair] = True
-                        seqNum = seqNum + 1
-
-                        newProperty = copy.copy(row)
-                        newProperty['_PropertyTerm_key'] = SOURCE_ANNOT_KEY
-                        newProperty['sequenceNum'] = seqNum
-                        newProperty['value'] = newProperty['_Annot_key']
-                        seqRows.append(newProperty)
-
-                # and add the new source property
-                byEvidenceKey[evidenceKey] = rows + seqRows
-                added = added + len(seqRows)
-
-        _stamp('27:add source key properties for records with existing properties: %d' % added)
+def _getEvidenceProperties ():
+        # get the properties from VOC_Evidence_Property for evidence records,
+        # which are for annotations in the current batch (batch_annots), as
+        # the single properties value expected by the annotload for each
+        # evidence record.
+        #
+        # Each evidence record also gets an extra property for each of its
+        # markers, to refer back to the _Annot_key of the annotation from
+        # which the derived one comes.  These evidence records are all for
+        # source annotations (not derived ones), so none of them would
+        # already have a _SourceAnnot_key property.  The extra property
+        # follows the existing ones:  it joins their stanza if there is only
+        # one, forms its own last stanza if there are several, and is stanza
+        # 1 if there are no other properties.
+        #
+        # Clauses are property&=&value, separated by &==& within a stanza,
+        # and stanzas are separated by &===&.
+        #
+        # Returns: { marker key : { _AnnotEvidence_key : properties value } }
 
-        # need to handle evidence rows which had no properties previously
+        _stamp('27:_getEvidenceProperties')
 
-        ct = 0
-        for row in rawEvidence:
-                evidenceKey = row['_AnnotEvidence_key']
-                markerKey = row['_Marker_key']
+        propertyVocab = os.environ['ANNOTPROPERTY']
 
-                # Add a source row if the annotation had no evidence at all.
-                pair = (evidenceKey, markerKey)
-                if pair not in evidenceMarkerPairs:
-                        r = {
-                                '_Marker_key' : markerKey,
-                                '_AnnotEvidence_key' : evidenceKey,
-                                '_PropertyTerm_key' : SOURCE_ANNOT_KEY,
-                                'stanza' : 1,
-                                'sequenceNum' : 1,
-                                'value' : row['_Annot_key'],
-                                '_CreatedBy_key' : row['_CreatedBy_key'],
-                                '_ModifiedBy_key' : row['_ModifiedBy_key'],
-                                'creation_date' : row['creation_date'],
-                                'modification_date' : row['modification_date'],
-                                }
-
-                        if evidenceKey not in byEvidenceKey:
-                                byEvidenceKey[evidenceKey] = [ r ]
-                        else:
-                                byEvidenceKey[evidenceKey].append(r)
+        cmd = '''
+                with pairs as (
+                        select b._Marker_key, e._Annot_key, e._AnnotEvidence_key
+                        from batch_annots b, VOC_Evidence e
+                        where b._Annot_key = e._Annot_key
+                ),
+                clauses as (
+                        select x._Marker_key, x._AnnotEvidence_key, p.stanza as run,
+                                0 as is_source, p.sequenceNum,
+                                coalesce(t.term, 'None') || '&=&' || coalesce(p.value, 'None') as clause
+                        from pairs x, VOC_Evidence_Property p
+                                left outer join VOC_Term t on (p._PropertyTerm_key = t._Term_key
+                                        and t._Vocab_key = %s)
+                        where x._AnnotEvidence_key = p._AnnotEvidence_key
+                        union all
+                        select x._Marker_key, x._AnnotEvidence_key,
+                                case when m.min_stanza is null then 1
+                                        when m.min_stanza = m.max_stanza then m.min_stanza
+                                        else m.max_stanza + 1
+                                end as run,
+                                1 as is_source, 0 as sequenceNum,
+                                coalesce((select t.term from VOC_Term t
+                                        where t._Term_key = %d
+                                        and t._Vocab_key = %s), 'None')
+                                        || '&=&' || x._Annot_key::text as clause
+                        from pairs x
+                                left outer join lateral (select min(p.stanza) as min_stanza,
+                                                max(p.stanza) as max_stanza
+                                        from VOC_Evidence_Property p
+                                        where p._AnnotEvidence_key = x._AnnotEvidence_key
+                                ) m on true
+                ),
+                stanzas as (
+                        select _Marker_key, _AnnotEvidence_key, run,
+                                string_agg(clause, '&==&' order by is_source, sequenceNum) as stanza
+                        from clauses
+                        group by _Marker_key, _AnnotEvidence_key, run
+                )
+                select _Marker_key, _AnnotEvidence_key,
+                        string_agg(stanza, '&===&' order by run) as properties
+                from stanzas
+                group by _Marker_key, _AnnotEvidence_key
+                ''' % (propertyVocab, SOURCE_ANNOT_KEY, propertyVocab)
 
-                        evidenceMarkerPairs[pair] = True
-                        ct = ct + 1
+        results = _executePrepared('get_evidence_properties', cmd)
+        _stamp('27:Retrieved properties for evidence records: %d' % len(results))
 
-        _stamp('27:add source key properties for records with no existing properties: %d' % ct)
-        _stamp('27:add source key properties in all: %d' % len(byEvidenceKey))
+        byMarker = {}
+        for row in results:
+                byMarker.setdefault(row['_Marker_key'], {})[row['_AnnotEvidence_key']] = row['properties']
 
-        return byEvidenceKey
+        return byMarker
 
-def _getNotes (startMarker, endMarker):
+def _getNotes ():
         # get notes from MGI_Note for evidence records, which
-        # are for annotations which can be rolled up to markers between the
-        # given 'startMarker' and 'endMarker', inclusive.
-        # Returns: { _AnnotEvidence_key : { note key : { record from database } } }
-        # handle basic data for each note
+        # are for annotations in the current batch (batch_annots).
+        # Returns: { marker key : { _AnnotEvidence_key : { note key : { record from database } } } }
 
         _stamp('28:_getNotes')
 
@@ -1891,123 +2010,51 @@ def _getNotes (startMarker, endMarker):
         # BACKGROUND_SENSITIVITY_NOTE = 1015	# note type key for background;sensitivity notes for evidence
 
         cmd = '''
-                select distinct k._Marker_key, n.*
-                from genotype_keepers k,
-                        VOC_Annot a,
+                select distinct b._Marker_key, n._Object_key, n._Note_key, n.note
+                from batch_annots b,
                         VOC_Evidence e,
                         MGI_Note n
-                where k._Genotype_key = a._Object_key
-                        and a._AnnotType_key in (%d)
-                        and a._Term_key != %d
-                        and k._Marker_key >= %d
-                        and k._Marker_key <= %d
-                        and a._Annot_key = e._Annot_key
+                where b._Annot_key = e._Annot_key
                         and e._AnnotEvidence_key = n._Object_key
                         and n._NoteType_key in (1008, 1015)             -- general note/background;sensitivity note
-                order by n._Object_key''' % (
-                        CURRENT_ANNOT_TYPE, NO_PHENOTYPIC_ANALYSIS,
-                        startMarker, endMarker,
-                        )
+                order by n._Object_key'''
 
-        results = db.sql(cmd, 'auto')
+        results = _executePrepared('get_notes', cmd)
 
-        notes = {}		# evidence key -> notes
-        noteToEvidence = {}	# note key -> evidence key
+        notes = {}		# marker key -> evidence key -> notes
 
         for row in results:
-                evidenceKey = row['_Object_key']
-                noteKey = row['_Note_key']
-
-                if evidenceKey in notes:
-                        notes[evidenceKey][noteKey] = row
-                else:
-                        notes[evidenceKey] = { noteKey : row }
-
-                noteToEvidence[noteKey] = evidenceKey
+                notes.setdefault(row['_Marker_key'], {}).setdefault(row['_Object_key'], {})[row['_Note_key']] = row
 
         #print(notes)
         return notes
 
-def _splitByMarker (results):
-        # take a dictionary keyed by some other field, with values being a
-        # list of data rows (each containing a _Marker_key), and group those
-        # rows into a dictionary with the marker keys at the top level, as:
-        # 	{ marker key : { original key : [ original rows ] }
-        # This is so we can easily determine which rows go with which markers.
-
-        byMarker = {}
-
-        originalKeys = list(results.keys())
-        for key in originalKeys:
-                for row in results[key]:
-                        markerKey = row['_Marker_key']
-
-                        if markerKey not in byMarker:
-                                byMarker[markerKey] = { key : [ row ] }
-
-                        elif key not in byMarker[markerKey]:
-                                byMarker[markerKey][key] = [ row ]
-
-                        else:
-                                byMarker[markerKey][key].append (row)
-        return byMarker
-
-def _splitNotesByMarker (notes):
-        # takes dictionary of results, as returned by _getNotes() and splits
-        # them up by marker, returning a dictionary where a marker key
-        # goes to a dictionary of those evidence records for that marker.
-
-        byMarker = {}
-
-        for evidenceKey in list(notes.keys()):
-                noteKeys = list(notes[evidenceKey].keys())
-
-                # just need to get the marker from the first note
-
-                if noteKeys:
-                        noteKey = noteKeys[0]
-                        markerKey = notes[evidenceKey][noteKey]['_Marker_key']
-
-                # Each evidence key is only for one marker, so we don't need
-                # to worry about overwriting an existing evidenceKey for a
-                # marker.
-
-                if markerKey not in byMarker:
-                        byMarker[markerKey] = { evidenceKey : notes[evidenceKey] }
-                else:
-                        byMarker[markerKey][evidenceKey] = notes[evidenceKey]
-        return byMarker
-
 def _getMarkers (startMarker, endMarker):
-        # get a list of Marker objects (including annotations, evidence, and properties) 
-        # for all markers between (and including) the two given marker keys
+        # generator; yields Marker objects (including annotations, evidence, and properties) 
+        # for all markers between (and including) the two given marker keys.
+        # The batch's rows are fetched on the first request, and each Marker
+        # is only built when it is requested.
 
         _stamp('24:_getMarkers')
 
-        # marker key -> list of annotation rows
-        annotations = _getAnnotations(startMarker, endMarker)
+        _fillBatchTable(startMarker, endMarker)
 
+        # marker key -> list of annotation rows, and
         # marker key -> annotation key -> evidence rows 
-        evidenceResults, rawEvidence =_getEvidence(startMarker, endMarker)
-        evidence = _splitByMarker(evidenceResults)
-        _stamp('24:returned rawEvidence rows: %d' % len(rawEvidence))
+        annotations, evidence, evidenceCount = _getAnnotationsAndEvidence()
+        _stamp('24:returned evidence rows: %d' % evidenceCount)
 
-        # marker key -> evidence key -> property rows
-        properties = _splitByMarker(_getEvidenceProperties(startMarker, endMarker, rawEvidence))
+        # marker key -> evidence key -> properties value
+        properties = _getEvidenceProperties()
         _stamp('24:received properties for markers: %d' % len(properties))
 
         # marker key -> evidence key -> note rows
-        notes = _splitNotesByMarker(_getNotes(startMarker, endMarker))
+        notes = _getNotes()
         _stamp('24:received notes for markers: %d' % len(notes))
 
         # Returns: { _AnnotEvidence_key : { note key : { record from database } } }
 
-        markerKeys = list(annotations.keys())
-        markerKeys.sort()
-
-        markers = []		# list of Marker object to return
-
-        for markerKey in markerKeys:
+        for markerKey in sorted(annotations):
                 marker = Marker(markerKey)
                 marker.setAnnotations(annotations[markerKey])
 
@@ -2018,10 +2065,9 @@ def _getMarkers (startMarker, endMarker):
                 if markerKey in notes:
                         marker.setNotes(notes[markerKey])
 
-                markers.append(marker)
+                yield marker
 
-        gc.collect()
-        return markers
+        return
 
 ###--- public functions ---###
 
@@ -2030,14 +2076,11 @@ def setAnnotationType (annotType):
 
         global CURRENT_ANNOT_TYPE, SOURCE_ANNOT_KEY
 
-        if annotType in (DO_GENOTYPE, MP_GENOTYPE):
-                CURRENT_ANNOT_TYPE = annotType
-                if annotType == DO_GENOTYPE:
-                        SOURCE_ANNOT_KEY = 13611348
-                else:
-                        SOURCE_ANNOT_KEY = 13576001 
-        else:
+        if annotType not in SOURCE_ANNOT_KEYS:
                 raise Error('Unknown MGI Type: %d' % annotType)
+
+        CURRENT_ANNOT_TYPE = annotType
+        SOURCE_ANNOT_KEY = SOURCE_ANNOT_KEYS[annotType]
         return
 
 def getNextMarker():
@@ -2049,21 +2092,19 @@ def getNextMarker():
         if not INITIALIZED:
                 _initialize()
 
-        if not MARKERS_TO_DO:
+        marker = next(MARKERS_TO_DO, None)
+
+        # move on to the next batch when the current one is used up (and
+        # past any batch that turns out to have no markers)
+
+        while marker is None:
                 startMarker, endMarker = _getNextMarkerBatch()
 
                 if startMarker == None:
                         return None
 
                 MARKERS_TO_DO = _getMarkers (startMarker, endMarker)
-        
-        if not MARKERS_TO_DO:
-                return None
-
-        # pop the first marker off the list and return it
-
-        marker = MARKERS_TO_DO[0]
-        MARKERS_TO_DO = MARKERS_TO_DO[1:]
+                marker = next(MARKERS_TO_DO, None)
 
         return marker
 